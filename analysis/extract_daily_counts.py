@@ -0,0 +1,204 @@
+"""Extract the full daily count series for each data source into a shared
+local store, read by the database-builds and database-history notebooks
+
+Each source is extracted once per import, from the earliest date any
+notebook reports on, so both notebooks show slices of the same series.
+
+"""
+import os
+import sys
+
+import pandas as pd
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root_dir, "lib"))
+
+from functions import closing_connection
+from extraction import datequery, splitperiods, extractsources, derivecounts
+from dailystore import updateseries
+from schema import table_size_query
+from planner import extractionplan, planqueries, overrides
+from builds import latest_builds_query, latest_import, tablestamps
+from vintages import writevintage
+from outputs import replacing
+
+
+# the checkpoints and partitions are what a re-run resumes from, see lib/outputs.py
+store_dir = os.path.join(root_dir, "output", "daily_counts")
+checkpoint_dir = os.path.join(store_dir, "checkpoints")
+partition_dir = os.path.join(root_dir, "output", "partitions")
+# each import's daily counts, kept to measure how much later imports revise them, see lib/vintages.py
+vintage_dir = os.path.join(store_dir, "vintages")
+
+# database-history reports from here, database-builds from 2020-02-01
+start_date = "2016-01-01"
+
+# The tables and date columns to count are planned from OpenSAFELYSchemaInformation by lib/planner.py, so every table
+# with an event date gets a series. The established sources keep their names and columns through planner.overrides.
+# The plan is saved to the store as plan.csv, for the notebooks to label each series.
+
+# the periods each source is counted by, in the same scan; the daily counts are saved as daily counts files, and any
+# weekly ("week") or monthly ("month") totals to a csv, so a view that only needs them can be read without the daily
+# detail. Both notebooks read the daily counts, and database-history resamples them to weeks itself, so only days are
+# counted: asking for weeks or months too would only add rows to every query
+periods = ("day",)
+
+# sources also counted by a stratum of each patient's practice registration on the event date, as
+# (stratum, date, count) rows from one aggregate query each, saved as csv rather than daily counts files
+# every event is counted in exactly one stratum ("Unknown" if the patient wasn't registered), so the source's own
+# daily counts are the totals of its strata, rather than another scan of its table
+stratified = {
+    "APCS_by_region": ("APCS", "region"),
+    "EC_by_region": ("EC", "region"),
+    "SGSSpos_by_region": ("SGSSpos", "region"),
+    "SGSSneg_by_region": ("SGSSneg", "region"),
+}
+
+# series made by adding up other sources on the client, rather than with a
+# UNION ALL on the server, so each table is only scanned once
+derived = {
+    "SGSS": ["SGSSpos", "SGSSneg"],
+    "SGSS_all": ["SGSSpos_all", "SGSSneg_all"],
+    "SGSS_by_region": ["SGSSpos_by_region", "SGSSneg_by_region"],
+}
+
+# Tables can be counted from a sample of their rows, for estimated counts with confidence intervals, by giving them a
+# sample rate in planner.overrides, eg "CodedEvent": dict(column="ConsultationDate", partitioned=True, sample=0.01)
+
+# sources run at the same time, sharing this many database connections
+max_workers = 4
+
+# partitioned sources are limited a month at a time rather than as a whole: any month running for longer than this
+# (seconds) is cancelled, and the source has its own budget rather than what is left of the other sources'
+partition_timeout = 60*60
+partition_budget = 12*60*60
+
+
+def build_plan(dbconn):
+    """Return the extraction plan for the tables in the current schema
+    """
+    with closing_connection(dbconn) as cnxn:
+        table_schema = pd.read_sql("select * from OpenSAFELYSchemaInformation", cnxn)
+        try:
+            sizes = pd.read_sql(table_size_query, cnxn)
+        except Exception:
+            # without table sizes only the tables in planner.overrides are partitioned
+            sizes = None
+    return extractionplan(table_schema, sizes)
+
+
+def source_stamps(dbconn, plan):
+    """Return the BuildDate of the latest import of each source, so that only
+    sources imported since they were last extracted are extracted again
+    """
+    with closing_connection(dbconn) as cnxn:
+        builds = pd.read_sql(latest_builds_query, cnxn)
+    stamps = tablestamps(list(plan['table']) + ["RegistrationHistory"], builds)
+    sources = {name: stamps[table] for name, table in zip(plan['name'], plan['table'])}
+    # stratified counts also change when the registrations are imported
+    for name, (source, stratum) in stratified.items():
+        if source in sources:
+            sources[name] = max(sources[source], stamps["RegistrationHistory"])
+    return sources
+
+
+def build_queries(dbconn, stamps, plan):
+    """Return the query for each source, for extractsources
+    """
+    # each source is counted up to the date of its own latest import
+    to_dates = {name: stamp[:10] for name, stamp in stamps.items()}
+    queries = planqueries(plan, dbconn, start_date, to_dates, partition_dir, periods=periods, partition_timeout=partition_timeout)
+    planned = plan[plan['included']].set_index('name')
+    for name, (source, stratum) in stratified.items():
+        if source in planned.index:
+            queries.pop(source, None)
+            queries[name] = datequery(planned.loc[source, 'table'], planned.loc[source, 'var'], start_date, to_dates[source], stratum=stratum)
+    return queries
+
+
+def main():
+    dbconn = os.environ.get('FULL_DATABASE_URL', None).strip('"')
+    os.makedirs(store_dir, exist_ok=True)
+    end_date = latest_import(dbconn)
+
+    plan = build_plan(dbconn)
+    plan.to_csv(os.path.join(store_dir, "plan.csv"), index=False)
+    stamps = source_stamps(dbconn, plan)
+
+    # Each source is checkpointed as it completes, and a source that fails is
+    # skipped rather than stopping the run. Re-running only re-extracts
+    # sources that failed, or were extracted before their latest import.
+    # Any query running for more than two hours is cancelled on the server,
+    # and sources still waiting once the six hour budget is used up are
+    # skipped. The established sources are run first, including the stratified
+    # extracts that their totals come from, then the tables found in the
+    # schema, and the slow partitioned extracts last, with their own limits.
+    partitioned = list(plan.loc[plan['included'] & plan['partitioned'], 'name'])
+    priority = {name: 0 if table in overrides else 2 for name, table in zip(plan['name'], plan['table'])}
+    priority.update({name: 0 for name in stratified})
+    priority.update({name: 3 for name in partitioned})
+    timeout = {name: None if name in partitioned else 2*60*60 for name in priority}
+    budget = {name: partition_budget if name in partitioned else 6*60*60 for name in priority}
+    counts, summary = extractsources(
+        dbconn, build_queries(dbconn, stamps, plan), checkpoint_dir, stamp=stamps,
+        timeout=timeout, budget=budget, priority=priority, max_workers=max_workers
+    )
+
+    # the sources counted by stratum are the totals of their strata
+    totals = {source: [name] for name, (source, stratum) in stratified.items() if source in set(plan.loc[plan['included'], 'name'])}
+    for source, (name,) in totals.items():
+        if name in counts:
+            counts[source] = counts[name].groupby('date', as_index=False)['count'].sum()
+
+    counts = derivecounts(counts, derived)
+    derived_summary = []
+    for name, bases in {**totals, **derived}.items():
+        if name in counts:
+            derived_summary.append(dict(source=name, status="derived", rows=len(counts[name]), error=None))
+        else:
+            derived_summary.append(dict(source=name, status="failed", rows=0, error=f"needs {', '.join(bases)}"))
+    summary = pd.concat([summary, pd.DataFrame(derived_summary)], ignore_index=True, sort=False)
+
+    # derived series are as recent as the latest import of the sources they're made from
+    for name, bases in derived.items():
+        stamps[name] = max(stamps.get(base, end_date) for base in bases)
+
+    # sources that failed this time have no file in the store, rather than one from an earlier import
+    for name in list(plan['name']) + list(stratified) + list(derived):
+        path = os.path.join(store_dir, f"{name}.counts")
+        stratified_path = os.path.join(store_dir, f"{name}.csv")
+        periods_path = os.path.join(store_dir, f"{name}_periods.csv")
+        interval_path = os.path.join(store_dir, f"{name}_interval.csv")
+        if name in counts and 'stratum' in counts[name].columns:
+            with replacing(stratified_path) as tmp_path:
+                counts[name].to_csv(tmp_path, index=False)
+        elif name in counts:
+            # sources totalled from their strata only have daily counts, and a source whose query returned no rows
+            # has an empty series, rather than no file
+            by_period = splitperiods(counts[name]) if 'period' in counts[name].columns else {'day': counts[name]}
+            daily = by_period.get('day', pd.DataFrame({'date': pd.to_datetime([]), 'count': pd.Series([], dtype='int64')}))
+            updateseries(path, name, daily, stamps.get(name, end_date)[:10])
+            writevintage(vintage_dir, name, daily, stamps.get(name, end_date)[:10])
+            coarse = counts[name][counts[name]['period'] != "day"] if 'period' in counts[name].columns else []
+            if len(coarse) > 0:
+                with replacing(periods_path) as tmp_path:
+                    coarse.to_csv(tmp_path, index=False)
+            elif os.path.exists(periods_path):
+                os.remove(periods_path)
+            # sampled sources' daily counts are estimates, with their confidence intervals saved alongside
+            if 'lower' in daily.columns:
+                with replacing(interval_path) as tmp_path:
+                    daily[['date', 'sampled', 'lower', 'upper']].to_csv(tmp_path, index=False)
+            elif os.path.exists(interval_path):
+                os.remove(interval_path)
+        else:
+            for stale in [path, stratified_path, periods_path, interval_path]:
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+    summary.to_csv(os.path.join(store_dir, "summary.csv"), index=False)
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Profile the data quality of every table in the database, saving one
+profile per build so changes between builds can be reported by the
+database-schema notebook
+
+Each table is profiled by a single query generated from its column types
+in OpenSAFELYSchemaInformation, see lib/quality.py.
+
+The profiles of earlier builds are read back from this script's own
+earlier outputs, see lib/outputs.py.
+
+"""
+import os
+import sys
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root_dir, "lib"))
+
+from functions import closing_connection
+from extraction import readquery
+from quality import profilequeries, profileframe
+from builds import latest_builds_query, latest_import, tablestamps
+from outputs import replacing
+
+
+profile_dir = os.path.join(root_dir, "output", "profiles")
+
+# tables profiled at the same time, each on its own connection
+max_workers = 4
+
+# each profile query is cancelled on the server if it runs for longer than this (seconds)
+timeout = 2*60*60
+
+
+def main():
+    dbconn = os.environ.get('FULL_DATABASE_URL', None).strip('"')
+    build = latest_import(dbconn)
+    build_dir = os.path.join(profile_dir, build)
+    os.makedirs(build_dir, exist_ok=True)
+
+    with closing_connection(dbconn) as cnxn:
+        table_schema = pd.read_sql("select * from OpenSAFELYSchemaInformation", cnxn)
+        builds = pd.read_sql(latest_builds_query, cnxn)
+
+    queries = profilequeries(table_schema)
+    stamps = tablestamps(list(queries), builds)
+    earlier = sorted(previous for previous in os.listdir(profile_dir) if previous < build)
+    previous_dir = os.path.join(profile_dir, earlier[-1]) if earlier else None
+
+    # Each table's profile is saved as it completes, so re-running for the
+    # same build only profiles the tables that failed or weren't reached.
+    # Tables that haven't been imported since the previous build's profile
+    # keep that profile rather than being profiled again.
+    def profiletable(item):
+        table, (columns, query) = item
+        path = os.path.join(build_dir, f"{table}.csv")
+        if os.path.exists(path):
+            return dict(table=table, status="reused", error=None)
+        previous_path = None if previous_dir is None else os.path.join(previous_dir, f"{table}.csv")
+        if previous_path is not None and os.path.exists(previous_path) and stamps[table][:10] <= os.path.basename(previous_dir):
+            with replacing(path) as tmp_path:
+                shutil.copyfile(previous_path, tmp_path)
+            return dict(table=table, status="unchanged", error=None)
+        try:
+            profile = profileframe(table, columns, readquery(dbconn, query, timeout=timeout))
+        except Exception as e:
+            return dict(table=table, status="failed", error=f"{type(e).__name__}: {e}")
+        with replacing(path) as tmp_path:
+            profile.to_csv(tmp_path, index=False)
+        return dict(table=table, status="profiled", error=None)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summary = pd.DataFrame(executor.map(profiletable, queries.items()))
+
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
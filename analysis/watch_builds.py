@@ -0,0 +1,134 @@
+"""Watch for new dataset imports, and re-run only the actions they affect
+
+Polls the LatestBuildTime table, which is cheap to read, and when it
+changes works out from BuildInfo which datasets have been imported since
+the last run. Only the actions that report on the tables those imports
+changed are re-run, with `opensafely run`, so each still runs in its own
+image and its outputs are kept by the job runner (see lib/builds.py, and
+lib/outputs.py for the outputs that later runs read back).
+
+Run locally, with FULL_DATABASE_URL set, as
+
+    python analysis/watch_builds.py [--once] [--interval MINUTES]
+
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import pandas as pd
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(root_dir, "lib"))
+
+from functions import closing_connection
+from planner import extractionplan
+from builds import latest_builds_query, schema_checksum_query, changedbuilds, changedtables
+from outputs import replacing
+
+
+state_path = os.path.join(root_dir, "output", "builds", "watch_state.json")
+
+# the status of each source in the last extraction, written by analysis/extract_daily_counts.py
+summary_path = os.path.join(root_dir, "output", "daily_counts", "summary.csv")
+
+# actions showing the daily counts of every table with an event date, re-run when any of those tables is imported
+extraction_actions = ["extract_daily_counts", "database_builds_html", "database_builds_md", "database_history_html", "database_freshness_html"]
+
+# actions showing every table's schema and data quality, re-run when any table is imported or the schema changes
+schema_actions = ["profile_tables", "database_schema_html", "database_schema_md"]
+
+
+def readstate():
+    if not os.path.exists(state_path):
+        return dict(latest_build_time=None, builds=None, schema=None)
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def writestate(state):
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with replacing(state_path) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+
+
+def affected_actions(dbconn, state):
+    """Return the actions affected by the imports since `state`, and the
+    new state to save once they have run
+    """
+    with closing_connection(dbconn) as cnxn:
+        builds = pd.read_sql(latest_builds_query, cnxn)
+        table_schema = pd.read_sql("select * from OpenSAFELYSchemaInformation", cnxn)
+        checksum = int(pd.read_sql(schema_checksum_query, cnxn)['checksum'].iloc[0])
+
+    previous = None if state['builds'] is None else pd.DataFrame(state['builds'])
+    changed = changedbuilds(previous, builds)
+    plan = extractionplan(table_schema)
+    tables = changedtables(list(plan['table']), changed, builds)
+    included = set(plan.loc[plan['included'], 'table'])
+
+    actions = []
+    if included.intersection(tables):
+        actions += extraction_actions
+    if tables or checksum != state['schema']:
+        actions += schema_actions
+
+    print(f"imported: {', '.join(changed) or 'nothing'}; tables affected: {', '.join(tables) or 'none'}")
+    builds = builds.assign(BuildDate=builds['BuildDate'].astype(str))
+    return actions, dict(state, builds=builds.to_dict('records'), schema=checksum)
+
+
+def poll(dbconn, state):
+    """Check for new imports once, re-running the affected actions, and
+    return the state to poll from next
+    """
+    with closing_connection(dbconn) as cnxn:
+        latest_build_time = pd.read_sql("select * from LatestBuildTime", cnxn).astype(str).to_dict('records')
+    if latest_build_time == state['latest_build_time']:
+        return state
+
+    actions, new_state = affected_actions(dbconn, state)
+    if actions:
+        print(f"running: {', '.join(actions)}")
+        result = subprocess.run(["opensafely", "run", *actions], cwd=root_dir)
+        if result.returncode != 0:
+            # the state isn't saved, so the same actions are tried again on the next poll
+            print(f"opensafely run failed with exit code {result.returncode}")
+            return state
+    if "extract_daily_counts" in actions:
+        # the extraction completes even when sources fail or run out of time, so they are tried again the same way
+        summary = pd.read_csv(summary_path)
+        incomplete = summary.loc[summary['status'].isin(["failed", "skipped"]), 'source']
+        if len(incomplete) > 0:
+            print(f"not extracted: {', '.join(incomplete)}")
+            return state
+
+    new_state['latest_build_time'] = latest_build_time
+    writestate(new_state)
+    return new_state
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--once", action="store_true", help="check for new imports once, rather than polling")
+    parser.add_argument("--interval", type=float, default=15, help="minutes between polls (default 15)")
+    args = parser.parse_args()
+
+    dbconn = os.environ.get('FULL_DATABASE_URL', None).strip('"')
+    state = readstate()
+    while True:
+        try:
+            state = poll(dbconn, state)
+        except Exception as e:
+            # a failed poll (eg the database being unavailable during an import) is tried again next time
+            print(f"poll failed: {type(e).__name__}: {e}")
+        if args.once:
+            break
+        time.sleep(args.interval * 60)
+
+
+if __name__ == "__main__":
+    main()
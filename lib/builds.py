@@ -0,0 +1,119 @@
+import re
+import pandas as pd
+
+from functions import closing_connection
+
+
+
+# The dataset imports (builds) listed in BuildInfo, and the tables each one imports.
+#
+# BuildInfo only names each build by its BuildDesc, so each table is matched to the build whose BuildDesc shares most
+# of the words in its table name, eg SGSS_AllTests_Positive to an "SGSS" build. The matches can be overridden in
+# `build_overrides`. The primary care tables (CodedEvent, Appointment, Patient, ...) are named after what they hold rather
+# than where they come from, so tables that no build matches are taken to be imported by the SystmOne build, `core_build`.
+# Only if there is no such build are they treated as changing whenever any build is imported.
+#
+# This lets the extraction and profiling re-query only the tables whose own build has changed, rather than every
+# table whenever anything is imported, and lets analysis/watch_builds.py re-run only the actions that are affected.
+
+# the latest import of each build
+latest_builds_query = """
+    SELECT BuildDesc, MAX(BuildDate) AS BuildDate
+    FROM BuildInfo
+    GROUP BY BuildDesc
+"""
+
+# a checksum of the schema, which changes if any table or column is added, removed or altered, without reading the schema
+schema_checksum_query = """
+    SELECT CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS checksum
+    FROM OpenSAFELYSchemaInformation
+"""
+
+# the BuildDesc of the SystmOne import, which imports the tables that no other build matches
+core_build = "S1"
+
+# table: the BuildDesc of the build that imports it, where it can't be matched by name
+build_overrides = {}
+
+
+
+def latest_import(dbconn):
+    # the date of the most recent import of any dataset, as a 'YYYY-MM-DD' string
+    with closing_connection(dbconn) as cnxn:
+        latestbuilds = pd.read_sql("select max(BuildDate) as latest_import from BuildInfo", cnxn)
+    return pd.to_datetime(latestbuilds['latest_import'].max()).strftime('%Y-%m-%d')
+
+
+
+def words(name):
+    # the lower case words in a table name or BuildDesc, split at underscores, spaces, punctuation and camel case
+    return [word.lower() for word in re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", name)]
+
+
+
+def tablebuilds(tables, builds, overrides=build_overrides, core=core_build):
+    # the BuildDesc of the build that imports each table, as a series indexed by table
+    # a build whose BuildDesc is the table name is picked first. Otherwise a build matches a table if its BuildDesc
+    # contains the first word of the table name, and the build containing most of the table name's words is picked, eg
+    # "ONS CIS" rather than "ONS Deaths" for ONS_CIS, then the one with fewest other words, eg "SGSS_Positive" rather
+    # than "SGSS_AllTests_Positive" for SGSS_Positive, whatever order BuildInfo lists them in
+    # tables that no build matches are imported by the `core` build, or None if builds doesn't include it
+    # builds is the result of latest_builds_query
+
+    descs = list(builds['BuildDesc'])
+    desc_words = [set(words(desc)) for desc in descs]
+
+    matched = {}
+    for table in tables:
+        if table in overrides:
+            matched[table] = overrides[table]
+            continue
+        if table in descs:
+            matched[table] = table
+            continue
+        table_words = set(words(table))
+        first = words(table)[:1]
+        scores = [
+            (len(table_words & build_words), -len(build_words - table_words)) if first and first[0] in build_words else (0, 0)
+            for build_words in desc_words
+        ]
+        best = max(range(len(descs)), key=lambda i: scores[i], default=None)
+        matched[table] = descs[best] if best is not None and scores[best][0] > 0 else (core if core in descs else None)
+    return pd.Series(matched, dtype=object)
+
+
+
+def tablestamps(tables, builds, overrides=build_overrides):
+    # the BuildDate of the latest import of each table, as a dict of table: 'YYYY-MM-DD HH:MM:SS' string
+    # tables that no build matches, when there is no core build, get the latest BuildDate of any build
+
+    dates = pd.to_datetime(builds.set_index('BuildDesc')['BuildDate'])
+    matched = tablebuilds(tables, builds, overrides=overrides)
+    latest = dates.max()
+    return {
+        table: str(dates[desc] if desc is not None and desc in dates.index else latest)
+        for table, desc in matched.items()
+    }
+
+
+
+def changedbuilds(previous, builds):
+    # the BuildDescs that have been imported since `previous`, both results of latest_builds_query (previous can be None)
+
+    if previous is None or len(previous) == 0:
+        return sorted(builds['BuildDesc'])
+    before = pd.to_datetime(previous.set_index('BuildDesc')['BuildDate'])
+    after = pd.to_datetime(builds.set_index('BuildDesc')['BuildDate'])
+    changed = after.index[~after.index.isin(before.index) | (after > before.reindex(after.index))]
+    return sorted(changed)
+
+
+
+def changedtables(tables, changed, builds, overrides=build_overrides):
+    # the tables imported by the builds in `changed` (from changedbuilds), including tables that no build matches when
+    # there is no core build
+
+    if len(changed) == 0:
+        return []
+    matched = tablebuilds(tables, builds, overrides=overrides)
+    return [table for table, desc in matched.items() if desc is None or desc in changed]
@@ -0,0 +1,171 @@
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+from outputs import replacing
+
+
+
+# A compact file format for one source's daily counts.
+#
+# Each file holds a fixed-size header followed by one little-endian int32 count per day, for every day from the
+# first day to the last day in the series (days with no events are 0). Days are stored as offsets from a fixed epoch,
+# so the count for a date is at a known position, the whole series can be memory-mapped without parsing anything,
+# and new days can be appended without rewriting the file. Extracting each import rewrites a file only if the import
+# has changed days already in it, and otherwise appends just the new days.
+#
+# header: magic, first day, number of days, build date (both as day offsets), source name (utf-8, up to 64 bytes)
+
+epoch = pd.Timestamp("1900-01-01")
+magic = b"DAYCNT01"
+header_format = "<8siii64s"
+header_size = 128
+count_dtype = np.dtype("<i4")
+
+
+
+def dayoffset(dates):
+    # days since the epoch, for a date or an array of dates
+    if np.ndim(dates) == 0:
+        return int((pd.Timestamp(dates) - epoch) // pd.Timedelta(1, unit='D'))
+    return ((pd.to_datetime(dates) - epoch) // pd.Timedelta(1, unit='D')).to_numpy().astype(np.int64)
+
+
+
+def offsetdate(offsets):
+    # the date for a day offset, or a DatetimeIndex for an array of them
+    if np.ndim(offsets) == 0:
+        return epoch + pd.Timedelta(int(offsets), unit='D')
+    return epoch + pd.to_timedelta(np.asarray(offsets), unit='D')
+
+
+
+def packheader(name, first_day, ndays, build_date):
+    # names longer than 64 bytes are cut at the last whole character that fits
+    name = name.encode('utf-8')[:64].decode('utf-8', 'ignore').encode('utf-8')
+    header = struct.pack(header_format, magic, first_day, ndays, dayoffset(build_date), name)
+    return header.ljust(header_size, b"\0")
+
+
+
+def readheader(path):
+    # the header of a daily counts file, as a dict of name, first_date, last_date, ndays and build_date
+    with open(path, "rb") as f:
+        header = f.read(header_size)
+    file_magic, first_day, ndays, build_day, name = struct.unpack_from(header_format, header)
+    if file_magic != magic:
+        raise ValueError(f"{path} is not a daily counts file")
+    return dict(
+        name=name.rstrip(b"\0").decode('utf-8'),
+        first_date=offsetdate(first_day),
+        last_date=offsetdate(first_day + ndays - 1),
+        ndays=ndays,
+        build_date=offsetdate(build_day),
+    )
+
+
+
+def densecounts(df):
+    # a (date, count) dataframe as the first day offset and an int32 array with a count for every day in its span
+    if len(df) == 0:
+        return 0, np.zeros(0, dtype=count_dtype)
+    days = dayoffset(df['date'])
+    first_day = days.min()
+    counts = np.bincount(days - first_day, weights=df['count'].to_numpy(), minlength=days.max() - first_day + 1)
+    return int(first_day), counts.astype(count_dtype)
+
+
+
+def writeseries(path, name, df, build_date):
+    # write the daily counts in a (date, count) dataframe to a new daily counts file at `path`
+    first_day, counts = densecounts(df)
+    with replacing(path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(packheader(name, first_day, len(counts), build_date))
+        f.write(counts.tobytes())
+
+
+
+def appendseries(path, df, build_date=None):
+    # add the days in a (date, count) dataframe to the end of an existing daily counts file, without rewriting it
+    # days between the current last day and the first new day are filled with 0
+    # the new days must all come after the last day already in the file
+    header = readheader(path)
+    if len(df) == 0:
+        return
+
+    new_first_day, new_counts = densecounts(df)
+    last_day = dayoffset(header['last_date'])
+    if header['ndays'] > 0 and new_first_day <= last_day:
+        raise ValueError(f"{header['name']} already has counts up to {header['last_date'].date()}, so can only be appended to from the day after")
+
+    first_day = dayoffset(header['first_date']) if header['ndays'] > 0 else new_first_day
+    gap = np.zeros(new_first_day - last_day - 1 if header['ndays'] > 0 else 0, dtype=count_dtype)
+    ndays = header['ndays'] + len(gap) + len(new_counts)
+    build_date = header['build_date'] if build_date is None else build_date
+
+    with open(path, "r+b") as f:
+        f.seek(header_size + header['ndays'] * count_dtype.itemsize)
+        f.write(gap.tobytes())
+        f.write(new_counts.tobytes())
+        # only update the header once the new days are written
+        f.seek(0)
+        f.write(packheader(header['name'], first_day, ndays, build_date))
+
+
+
+def updateseries(path, name, df, build_date):
+    # write the daily counts in a (date, count) dataframe to the daily counts file at `path`, only appending the new days
+    # if the file already holds the same counts for every earlier day, and otherwise (eg when an import has revised
+    # earlier days, or there is no file yet) writing it anew
+    # returns True if the new days were appended
+
+    first_day, counts = densecounts(df)
+    if os.path.exists(path):
+        header, existing = readseries(path)
+        unchanged = (
+            header['ndays'] > 0
+            and dayoffset(header['first_date']) == first_day
+            and len(counts) >= header['ndays']
+            and np.array_equal(existing, counts[:header['ndays']])
+        )
+        ndays = header['ndays']
+        del existing
+        if unchanged and len(counts) > ndays:
+            appendseries(path, df[pd.to_datetime(df['date']) > header['last_date']], build_date)
+            return True
+        if unchanged:
+            # no new days, so only the build date in the header changes
+            with open(path, "r+b") as f:
+                f.write(packheader(header['name'], first_day, ndays, build_date))
+            return True
+    writeseries(path, name, df, build_date)
+    return False
+
+
+
+def readseries(path):
+    # the header of a daily counts file and a read-only memory-mapped int32 array of its counts, one per day from header['first_date']
+    header = readheader(path)
+    if header['ndays'] == 0:
+        return header, np.zeros(0, dtype=count_dtype)
+    counts = np.memmap(path, dtype=count_dtype, mode='r', offset=header_size, shape=(header['ndays'],))
+    return header, counts
+
+
+
+def readframe(path, from_date=None, to_date=None):
+    # the counts in a daily counts file as a (date, count) dataframe, for days with at least one event
+    # between from_date and to_date (inclusive), as would be returned by a datequery
+    header, counts = readseries(path)
+    first_day = dayoffset(header['first_date'])
+
+    start = 0 if from_date is None else min(max(dayoffset(from_date) - first_day, 0), len(counts))
+    end = len(counts) if to_date is None else min(max(dayoffset(to_date) - first_day + 1, 0), len(counts))
+
+    window = np.asarray(counts[start:end])
+    days = np.flatnonzero(window)
+    return pd.DataFrame({
+        'date': offsetdate(first_day + start + days),
+        'count': window[days].astype(np.int64),
+    })
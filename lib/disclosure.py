@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+
+
+# Disclosure control for count outputs.
+#
+# Small counts are suppressed across a whole matrix of counts at once, eg a (day x source) or (day x stratum) dataframe,
+# rather than series by series, so the cost is one vectorised pass however many sources or strata there are.
+# Counts of 1 to `threshold` are replaced with `replace` (use np.nan to hide them), zeros are left as they are,
+# and the remaining counts can optionally be rounded to the nearest multiple of `rounding`.
+# Each function also returns a boolean mask of the suppressed counts, for plots that mark them.
+
+threshold = 5
+replace = 3
+
+
+
+def redactvalues(values, threshold=threshold, replace=replace, rounding=None):
+    # suppress (and optionally round) an array of counts, of any shape
+    # returns the redacted counts as floats, and a boolean array of the counts that were suppressed
+
+    values = np.asarray(values, dtype=float)
+    mask = (values > 0) & (values <= threshold)
+
+    if rounding is not None:
+        values = np.round(values / rounding) * rounding
+
+    return np.where(mask, replace, values), mask
+
+
+
+def redact(counts, threshold=threshold, replace=replace, rounding=None):
+    # suppress (and optionally round) a dataframe or series of counts, eg a (day x source) matrix from countmatrix
+    # returns the redacted counts and the mask of suppressed counts, both with the same index (and columns) as counts
+
+    values, mask = redactvalues(counts.to_numpy(), threshold=threshold, replace=replace, rounding=rounding)
+
+    if isinstance(counts, pd.DataFrame):
+        return (
+            pd.DataFrame(values, index=counts.index, columns=counts.columns),
+            pd.DataFrame(mask, index=counts.index, columns=counts.columns),
+        )
+    return pd.Series(values, index=counts.index, name=counts.name), pd.Series(mask, index=counts.index, name=counts.name)
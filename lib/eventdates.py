@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+
+
+class EventColumn:
+    # one event date column, as day offsets from the EventDates base date
+    # dense columns hold a day for every row, with `missing` where there is no event (rows is None)
+    # sparse columns hold only the rows with an event, as parallel arrays of row positions and days
+
+    __slots__ = ('rows', 'days', 'missing')
+
+    def __init__(self, rows, days, missing):
+        self.rows = rows
+        self.days = days
+        self.missing = missing
+
+    @property
+    def nbytes(self):
+        return self.days.nbytes + (0 if self.rows is None else self.rows.nbytes)
+
+
+
+def makecolumn(rows, days, nrows, density):
+    # an EventColumn for events on `days` in `rows`, in the smallest integer type that holds the days
+    # stored sparsely if fewer than `density` of the nrows rows have an event
+    dtype = np.int16 if len(days) == 0 or (days.min() > -2**15 and days.max() < 2**15) else np.int32
+    missing = np.iinfo(dtype).min
+
+    if nrows == 0 or len(rows) / nrows < density:
+        return EventColumn(rows.astype(np.int32), days.astype(dtype), missing)
+
+    dense = np.full(nrows, missing, dtype=dtype)
+    dense[rows] = days
+    return EventColumn(None, dense, missing)
+
+
+
+class EventDates:
+    # a compact store of patient-level event dates, for the count functions in functions.py
+    # each column is held as int16 (or int32, if the dates span more than ~89 years) day offsets from base_date,
+    # rather than as datetime64[ns] values, and mostly-empty columns keep only the rows that have an event
+    # build one from a dataframe of date columns with EventDates.from_frame(df)
+
+    __slots__ = ('base_date', 'nrows', 'columns', '_data')
+
+    def __init__(self, base_date, nrows, data):
+        self.base_date = pd.Timestamp(base_date)
+        self.nrows = nrows
+        self.columns = list(data)
+        self._data = data
+
+    @classmethod
+    def from_frame(cls, df, base_date=None, density=1/3):
+        # convert a dataframe (or series) of date columns
+        # columns where fewer than `density` of rows have a date are stored sparsely
+
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+
+        values = {col: pd.to_datetime(df[col]).to_numpy(dtype='datetime64[D]') for col in df.columns}
+
+        if base_date is None:
+            present = [v[~np.isnat(v)] for v in values.values()]
+            present = [v.min() for v in present if len(v) > 0]
+            base_date = min(present) if present else np.datetime64('2000-01-01')
+        base = np.datetime64(pd.Timestamp(base_date), 'D')
+
+        columns = {}
+        for col, v in values.items():
+            isdate = ~np.isnat(v)
+            columns[col] = (np.flatnonzero(isdate), (v[isdate] - base).astype(np.int64))
+
+        return cls.from_columns(columns, len(df), base, density=density)
+
+    @classmethod
+    def from_columns(cls, columns, nrows, base_date, density=1/3):
+        # build from a dict of column name: (row positions, day offsets from base_date) for the rows with an event
+        data = {}
+        for col, (rows, days) in columns.items():
+            data[col] = makecolumn(np.asarray(rows), np.asarray(days), nrows, density)
+        return cls(base_date, nrows, data)
+
+    def __len__(self):
+        return self.nrows
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._data.values())
+
+    def events(self, col):
+        # the row positions and days (offsets from base_date) of the rows with an event in `col`
+        column = self._data[col]
+        if column.rows is not None:
+            return column.rows, column.days
+        rows = np.flatnonzero(column.days != column.missing)
+        return rows, column.days[rows]
+
+    def offsets(self, col, start_date):
+        # days from start_date of each event in `col`
+        rows, days = self.events(col)
+        shift = (self.base_date - pd.Timestamp(start_date)).days
+        return days.astype(np.int64) + shift
+
+    def dense(self, col, start_date, missing):
+        # days from start_date for every row in `col`, with `missing` for rows without an event
+        out = np.full(self.nrows, missing, dtype=np.int64)
+        rows, days = self.events(col)
+        out[rows] = days.astype(np.int64) + (self.base_date - pd.Timestamp(start_date)).days
+        return out
+
+    def anyevent(self):
+        # boolean array of the rows with an event in any column
+        found = np.zeros(self.nrows, dtype=bool)
+        for col in self.columns:
+            found[self.events(col)[0]] = True
+        return found
+
+    def subset(self, mask):
+        # a new EventDates holding only the rows where the boolean array `mask` is True, eg one stratum
+        mask = np.asarray(mask, dtype=bool)
+        newrow = np.cumsum(mask) - 1
+        data = {}
+        for col, column in self._data.items():
+            if column.rows is None:
+                data[col] = EventColumn(None, column.days[mask], column.missing)
+            else:
+                keep = mask[column.rows]
+                data[col] = EventColumn(newrow[column.rows[keep]].astype(np.int32), column.days[keep], column.missing)
+        return EventDates(self.base_date, int(mask.sum()), data)
+
+    def to_frame(self):
+        # back to a dataframe of datetime64 columns
+        base = np.datetime64(self.base_date, 'D')
+        frame = {}
+        for col in self.columns:
+            rows, days = self.events(col)
+            values = np.full(self.nrows, np.datetime64('NaT'), dtype='datetime64[ns]')
+            values[rows] = (base + days.astype('timedelta64[D]')).astype('datetime64[ns]')
+            frame[col] = values
+        return pd.DataFrame(frame)
@@ -0,0 +1,614 @@
+import os
+import time
+import json
+import hashlib
+import inspect
+import threading
+import pyodbc
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import closing_connection
+from dailystore import readframe
+from disclosure import redactvalues
+from outputs import replacing
+
+
+
+# strata that datequery can count by, from the practice each patient was registered with on the date of the event
+registration_strata = {
+    "region": "Organisation.Region",
+    "stp": "Organisation.STPCode",
+}
+
+
+
+def datequery(table, var, from_date, to_date=None, stratum=None, patient="Patient_ID", sample=None, sampling="patient"):
+    # sql for the daily count of rows in `table`, by the date in `var`
+    # `var` can be an expression, eg "CONVERT(date, IcuAdmissionDateTime)" for datetime columns
+    # from_date and to_date are inclusive 'YYYY-MM-DD' strings; leave to_date as None for no upper limit
+    # set stratum to a key of registration_strata (eg "region") for (stratum, date, count) rows, see stratifieddatequery
+    # set sample (eg 0.01) to count a sample of the rows only, see sampleclause; pass the result to samplecounts for estimates
+
+    if stratum is not None:
+        return stratifieddatequery(table, var, from_date, to_date, stratum, patient=patient, sample=sample, sampling=sampling)
+
+    where = f"{var} >= CONVERT(date, '{from_date}')"
+    if to_date is not None:
+        where = where + f" AND {var} <= CONVERT(date, '{to_date}')"
+    tablesample, where = sampleclause(sample, sampling, where, patient=patient)
+
+    query = (
+      f"""
+        SELECT {var} AS date, COUNT(*) AS count
+        FROM {table}{tablesample}
+        WHERE {where}
+        GROUP BY {var}
+        ORDER BY {var}
+      """
+    )
+    return query
+
+
+
+def stratifieddatequery(table, var, from_date, to_date, stratum, patient="Patient_ID", sample=None, sampling="patient"):
+    # sql for the daily count of rows in `table` by the date in `var`, and by the stratum of the practice each patient
+    # was registered with on that date, eg "region", so regional breakdowns need one aggregate query rather than a patient-level extract
+    # where registrations overlap the most recent one is used, so each row is counted once, and rows for patients with
+    # no registration on that date are counted as "Unknown", so the strata always add up to the unstratified counts
+
+    where = f"{var} >= CONVERT(date, '{from_date}')"
+    if to_date is not None:
+        where = where + f" AND {var} <= CONVERT(date, '{to_date}')"
+    tablesample, where = sampleclause(sample, sampling, where, patient=patient)
+
+    query = (
+      f"""
+        SELECT COALESCE(reg.stratum, 'Unknown') AS stratum, {var} AS date, COUNT(*) AS count
+        FROM {table}{tablesample}
+        OUTER APPLY (
+            SELECT TOP 1 {registration_strata[stratum]} AS stratum
+            FROM RegistrationHistory
+            JOIN Organisation ON Organisation.Organisation_ID = RegistrationHistory.Organisation_ID
+            WHERE RegistrationHistory.Patient_ID = {table}.{patient}
+                AND RegistrationHistory.StartDate <= {var}
+                AND RegistrationHistory.EndDate > {var}
+            ORDER BY RegistrationHistory.StartDate DESC, RegistrationHistory.EndDate DESC
+        ) AS reg
+        WHERE {where}
+        GROUP BY COALESCE(reg.stratum, 'Unknown'), {var}
+        ORDER BY COALESCE(reg.stratum, 'Unknown'), {var}
+      """
+    )
+    return query
+
+
+
+def sampleclause(sample, sampling, where, patient="Patient_ID"):
+    # the TABLESAMPLE clause (if any) and WHERE condition for counting a sample of about `sample` (eg 0.01) of a table's rows
+    # sampling is either
+    #   "patient": every row of one in round(1 / sample) patients, picked by Patient_ID modulo, so the same patients are
+    #     sampled on every day and every run. The whole table is still read, but far fewer rows are grouped and counted
+    #   "pages": TABLESAMPLE SYSTEM, every row on a random `sample` of the table's data pages. Pages that aren't sampled
+    #     are never read, so this is the fastest, but rows on the same page are often related, so the intervals from
+    #     samplecounts are narrower than they should be, and a different sample is taken on each run
+    # returns ("", where) if sample is None, so unsampled queries are unchanged
+
+    if sample is None:
+        return "", where
+    if sampling == "patient":
+        return "", f"{where} AND {patient} % {samplemodulus(sample)} = 0"
+    if sampling == "pages":
+        return f" TABLESAMPLE SYSTEM ({sample * 100:g} PERCENT)", where
+    raise ValueError(f"unknown sampling '{sampling}', use 'patient' or 'pages'")
+
+
+
+def samplemodulus(sample):
+    return max(int(round(1 / sample)), 1)
+
+
+
+def samplecounts(df, sample, sampling="patient", confidence=0.95):
+    # estimates of the full counts from the counts of a sampled datequery, periodquery or partitionedquery
+    # each count is scaled up by the sampling rate, and given a normal approximation `confidence` interval, treating each
+    # row as sampled independently. Rows of the same patient (or page) are sampled together, so the true interval is wider
+    # where patients have many rows on the same day
+    # returns df with count as the (rounded) estimate, and columns sampled (the count in the sample), lower and upper
+    # a small sampled count would be given away by its estimate, as that is only the count scaled up, however large it is,
+    # so where the sampled count is suppressed by disclosure.redactvalues the estimate and both bounds are its
+    # replacement value instead, which is suppressed again when the estimates are redacted
+
+    rate = 1 / samplemodulus(sample) if sampling == "patient" else sample
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+
+    sampled = df['count'].to_numpy(dtype=float)
+    replaced, small = redactvalues(sampled)
+    estimate = sampled / rate
+    margin = z * np.sqrt(sampled * (1 - rate)) / rate
+    return df.assign(
+        count=np.where(small, replaced, np.round(estimate)).astype(np.int64),
+        sampled=df['count'],
+        lower=np.where(small, replaced, np.maximum(estimate - margin, 0).round()),
+        upper=np.where(small, replaced, (estimate + margin).round()),
+    )
+
+
+
+def readsample(dbconn, query, sample, sampling="patient", timeout=None, slots=None):
+    # samplecounts for a sampled datequery or periodquery, for extractsources
+
+    return samplecounts(readquery(dbconn, query, timeout=timeout, slots=slots), sample, sampling=sampling)
+
+
+
+# the first day of the period containing each date, for periodquery
+# weeks are ISO weeks, starting on Monday whatever the server's DATEFIRST setting
+period_starts = {
+    "day": "{var}",
+    "week": "DATEADD(day, -((DATEPART(weekday, {var}) + @@DATEFIRST + 5) % 7), {var})",
+    "month": "DATEFROMPARTS(YEAR({var}), MONTH({var}), 1)",
+}
+
+
+
+def periodquery(table, var, from_date, to_date=None, periods=("day", "week", "month"), sample=None, sampling="patient", patient="Patient_ID"):
+    # sql for the count of rows in `table` by day, ISO week and/or month of the date in `var`, in a single scan with GROUPING SETS
+    # returns (period, date, count) rows, where date is the first day of the period, eg "week" rows are dated on Mondays
+    # ask for only the coarser periods, eg periods=("week", "month"), to fetch a fraction of the rows of a daily datequery
+    # the first and last weeks and months only count rows between from_date and to_date (inclusive)
+    # pass the result to splitperiods for a (date, count) dataframe for each period
+    # set sample to count a sample of the rows only, as for datequery
+
+    where = f"{var} >= CONVERT(date, '{from_date}')"
+    if to_date is not None:
+        where = where + f" AND {var} <= CONVERT(date, '{to_date}')"
+    tablesample, where = sampleclause(sample, sampling, where, patient=patient)
+
+    starts = ",\n                ".join(f"{period_starts[period].format(var=var)} AS {period}_start" for period in periods)
+    label = " ".join(f"WHEN GROUPING({period}_start) = 0 THEN '{period}'" for period in periods)
+    date = ", ".join(f"{period}_start" for period in periods)
+    date = f"COALESCE({date})" if len(periods) > 1 else date
+    sets = ", ".join(f"({period}_start)" for period in periods)
+
+    query = (
+      f"""
+        SELECT CASE {label} END AS period, {date} AS date, COUNT(*) AS count
+        FROM (
+            SELECT
+                {starts}
+            FROM {table}{tablesample}
+            WHERE {where}
+        ) AS a
+        GROUP BY GROUPING SETS ({sets})
+        ORDER BY period, date
+      """
+    )
+    return query
+
+
+
+def splitperiods(df):
+    # the (period, date, count) rows of a periodquery as a dict of period: (date, count) dataframe
+
+    return {
+        period: rows.drop(columns='period').sort_values('date').reset_index(drop=True)
+        for period, rows in df.groupby('period', sort=False)
+    }
+
+
+
+def firsteventquery(table, var, from_date, to_date=None, patient="Patient_ID"):
+    # sql for the daily count of patients' first-ever event in `table`, by the date in `var`
+    # each patient's first date is found on the server with MIN() ... GROUP BY, so only the daily counts are returned
+    # a patient whose first event is before from_date is not counted, even if they have later events
+
+    where = f"first_date >= CONVERT(date, '{from_date}')"
+    if to_date is not None:
+        where = where + f" AND first_date <= CONVERT(date, '{to_date}')"
+
+    query = (
+      f"""
+        SELECT first_date AS date, COUNT(*) AS count
+        FROM (
+            SELECT {patient}, MIN({var}) AS first_date
+            FROM {table}
+            GROUP BY {patient}
+        ) AS a
+        WHERE {where}
+        GROUP BY first_date
+        ORDER BY first_date
+      """
+    )
+    return query
+
+
+
+def cmlstatequery(states, from_date, to_date, strata=None, patient="Patient_ID"):
+    # sql for the daily changes in the number of patients whose most advanced state to date is each state,
+    # computed on the server so that only (stratum, date, state, delta) aggregates are returned rather than patient-level dates
+    # states is a list of (name, table, date column) in order of advancement, eg
+    #   [("test", "SGSS_Positive", "Earliest_Specimen_Date"), ("admission", "APCS", "Admission_Date"), ("death", "ONS_Deaths", "dod")]
+    # each patient's first date in each state is found with MIN() ... GROUP BY, and the earliest date of any more advanced state
+    # with a window function; a state is ignored if a more advanced one was reached earlier, as in eventcountcmldf
+    # CROSS APPLY then turns each kept state into an entry (+1) on its date and an exit (-1) on the next state's date
+    # strata is an optional table expression with patient and stratum columns, eg
+    #   "(SELECT Patient_ID, Sex AS stratum FROM Patient) AS strata"; patients not in it are not counted
+    # pass the result to cmlcountsfromdeltas for the same counts as eventcountcmldf, or straight to cmlinc_strata_plot
+
+    events = "\n            UNION ALL\n".join(
+        f"""            SELECT {patient} AS patient, {idx} AS state, '{name}' AS state_name, MIN({var}) AS day
+            FROM {table}
+            GROUP BY {patient}"""
+        for idx, (name, table, var) in enumerate(states)
+    )
+
+    if strata is None:
+        stratum, join, group = "'all'", "", ""
+    else:
+        stratum, join, group = "strata.stratum", f"JOIN {strata} ON strata.{patient} = kept.patient", "strata.stratum, "
+
+    query = (
+      f"""
+        WITH events AS (
+{events}
+        ),
+        ranked AS (
+            SELECT patient, state, state_name, day,
+                MIN(day) OVER (
+                    PARTITION BY patient ORDER BY state DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                ) AS later_day
+            FROM events
+            WHERE day IS NOT NULL
+        ),
+        kept AS (
+            SELECT patient, state, state_name, day, later_day
+            FROM ranked
+            WHERE later_day IS NULL OR day <= later_day
+        )
+        SELECT {stratum} AS stratum, x.date, kept.state_name AS state, SUM(x.delta) AS delta
+        FROM kept
+        {join}
+        CROSS APPLY (VALUES (kept.day, 1), (kept.later_day, -1)) AS x(date, delta)
+        WHERE x.date >= CONVERT(date, '{from_date}') AND x.date <= CONVERT(date, '{to_date}')
+        GROUP BY {group}x.date, kept.state_name
+        ORDER BY {group}x.date, kept.state_name
+      """
+    )
+    return query
+
+
+
+def partitiondates(from_date, to_date, freq="MS"):
+    # split the period from_date to to_date (inclusive) into consecutive, non-overlapping partitions
+    # freq is a pandas offset alias marking the start of each partition, eg "MS" for calendar months, "W-MON" for weeks
+    # returns a list of (start, end) timestamp pairs, with both ends inclusive
+
+    from_date = pd.to_datetime(from_date)
+    to_date = pd.to_datetime(to_date)
+
+    starts = [from_date] + [d for d in pd.date_range(from_date, to_date, freq=freq) if d > from_date]
+    ends = [start - pd.Timedelta(1, unit='D') for start in starts[1:]] + [to_date]
+
+    return list(zip(starts, ends))
+
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+
+def timedquery(cnxn, query, timeout):
+    # run a daily count query, cancelling it on the server if it has not finished within `timeout` seconds
+    # the connection's ODBC query timeout covers execution; the watchdog also cancels a query that is still returning rows
+
+    cursor = cnxn.cursor()
+    watchdog = threading.Timer(timeout, cursor.cancel)
+    watchdog.start()
+    try:
+        cursor.execute(query)
+        columns = [column[0] for column in cursor.description]
+        rows = [tuple(row) for row in cursor.fetchall()]
+    except pyodbc.Error as e:
+        # HYT00 is the driver's query timeout, HY008 a query cancelled by the watchdog
+        if e.args and e.args[0] in ("HYT00", "HY008"):
+            raise QueryTimeout(f"query cancelled after {timeout:.0f} seconds") from e
+        raise
+    finally:
+        watchdog.cancel()
+        cursor.close()
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+    return df
+
+
+
+def readquery(dbconn, query, retries=0, wait=60, timeout=None, slots=None):
+    # run a daily count query on a new connection, retrying up to `retries` times (pausing `wait` seconds in between) if it fails
+    # set timeout (seconds) to cancel the query on the server if it runs for longer, raising QueryTimeout. Timed out queries are not retried.
+    # slots is an optional semaphore shared between queries, to limit how many connections are open at once
+    # the timeout runs from when readquery is called, so time spent waiting for a slot, and on earlier attempts, counts
+    # against it, and a query never runs past the time it was given
+
+    deadline = None if timeout is None else time.time() + timeout
+    for attempt in range(retries + 1):
+        try:
+            with slots or nullcontext():
+                # the time left is worked out once there is a free slot
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise QueryTimeout("the time ran out before a connection was free")
+                with closing_connection(dbconn, timeout=remaining) as cnxn:
+                    if remaining is None:
+                        return pd.read_sql(query, cnxn, parse_dates=['date'])
+                    return timedquery(cnxn, query, remaining)
+        except QueryTimeout:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(wait)
+
+
+
+def stitchcounts(dfs):
+    # combine a list of (date, count) dataframes into a single daily series, summing counts for any date appearing more than once
+    # (stratum, date, count) and (period, date, count) dataframes are combined within each stratum or period
+
+    df = pd.concat(dfs, ignore_index=True)
+    keys = [key for key in ['stratum', 'period', 'date'] if key in df.columns]
+    df = df.groupby(keys, as_index=False)['count'].sum()
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+
+def partitionedquery(dbconn, table, var, from_date, to_date, freq="MS", max_workers=4, retries=2, partition_dir=None, timeout=None, partition_timeout=None, stratum=None, periods=None, slots=None, sample=None, sampling="patient"):
+    # daily counts for a very large table, extracted as many smaller date-range queries run in parallel rather than one long scan
+    # `var` should be a date, so use eg "CONVERT(date, ConsultationDate)" for datetime columns
+    # freq sets the partition size, eg "MS" for months, "W-MON" for weeks
+    # at most max_workers partitions (and therefore database connections) are run at the same time, and no more than
+    # the semaphore `slots` allows, if it is shared with other queries (eg by extractsources)
+    # each failed partition is retried up to `retries` times
+    # if partition_dir is given, each completed partition is saved there and is read back instead of re-queried on a re-run,
+    # so an interrupted extraction resumes from where it stopped. Clear partition_dir when the table is re-imported.
+    # set timeout (seconds) to limit the whole extraction: each partition is cancelled when the time runs out,
+    # and partitions not yet started are abandoned
+    # set partition_timeout (seconds) to cancel any one partition that runs for longer than this, leaving the others to run
+    # set periods (eg ("day", "week", "month")) to run a periodquery for each partition instead; weeks split between
+    # partitions are added back together
+    # set sample to count a sample of each partition, as for datequery; the stitched counts are scaled up by samplecounts
+    # returns a dataframe with date and count columns (and a stratum or period column if stratum or periods is given),
+    # as for a single datequery or periodquery
+
+    partitions = partitiondates(from_date, to_date, freq=freq)
+    deadline = None if timeout is None else time.time() + timeout
+
+    if partition_dir is not None:
+        os.makedirs(partition_dir, exist_ok=True)
+
+    def partitionfile(start, end):
+        return os.path.join(partition_dir, f"{start.strftime('%Y-%m-%d')}_{end.strftime('%Y-%m-%d')}.csv")
+
+    def runpartition(start, end):
+        if partition_dir is not None and os.path.exists(partitionfile(start, end)):
+            return pd.read_csv(partitionfile(start, end), parse_dates=['date'])
+
+        remaining = None if deadline is None else deadline - time.time()
+        if remaining is not None and remaining <= 0:
+            raise QueryTimeout("not started before the time ran out")
+        if partition_timeout is not None:
+            remaining = partition_timeout if remaining is None else min(remaining, partition_timeout)
+
+        if periods is None:
+            query = datequery(table, var, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), stratum=stratum, sample=sample, sampling=sampling)
+        else:
+            query = periodquery(table, var, start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'), periods=periods, sample=sample, sampling=sampling)
+        df = readquery(dbconn, query, retries=retries, timeout=remaining, slots=slots)
+
+        if partition_dir is not None:
+            with replacing(partitionfile(start, end)) as tmp_path:
+                df.to_csv(tmp_path, index=False)
+        return df
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(runpartition, start, end): (start, end) for start, end in partitions}
+
+    dfs = []
+    failed = []
+    for future, (start, end) in futures.items():
+        if future.exception() is not None:
+            failed.append(f"{start.strftime('%Y-%m-%d')} to {end.strftime('%Y-%m-%d')}: {future.exception()}")
+        else:
+            dfs.append(future.result())
+
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(partitions)} partitions of {table} failed:\n" + "\n".join(failed))
+
+    if sample is not None:
+        return samplecounts(stitchcounts(dfs), sample, sampling=sampling)
+    return stitchcounts(dfs)
+
+
+
+def querykey(query):
+    # a short fingerprint of a query, used to tell whether a checkpointed result came from the same query
+    # callables (eg a functools.partial of partitionedquery) are identified by their function name and arguments
+
+    if callable(query):
+        func = getattr(query, 'func', query)
+        text = func.__name__ + repr(getattr(query, 'args', ())) + repr(sorted(getattr(query, 'keywords', {}).items()))
+    else:
+        text = query
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+
+def readmanifest(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+
+def writemanifest(checkpoint_dir, manifest):
+    with replacing(os.path.join(checkpoint_dir, "manifest.json")) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+
+def extractsources(dbconn, queries, checkpoint_dir, stamp=None, max_age=None, timeout=None, budget=None, priority=None, max_workers=1):
+    # extract the daily counts for several sources, checkpointing each one to disk as it completes
+    # queries is a dict of source name: either a datequery sql string, or a function taking no arguments
+    #   and returning a (date, count) dataframe (eg functools.partial(partitionedquery, dbconn, ...))
+    # a failing source is recorded and skipped rather than stopping the whole run
+    # on a re-run, a source is only re-extracted if it failed last time or its checkpoint is stale, ie:
+    #   the query has changed, the stamp is different (eg pass the latest import date, or a dict of them by source),
+    #   or the checkpoint is older than max_age (a pd.Timedelta)
+    # timeout (seconds) is the longest any one source may run before its query is cancelled on the server
+    # budget (seconds) is the time allowed for the whole run; once it is used up, remaining sources are skipped
+    # timeout and budget can also be dicts by source name, eg to give slow sources longer (None for no limit)
+    # functions are only given the time left if they take a `timeout` argument (as partitionedquery and readsample do);
+    #   functions without one can't be stopped, so are run with no time limit and can run past the budget
+    # sources are run in order of priority (a dict of source name: number, lowest first, default 0), so put
+    #   the most important sources first and the slow, less important ones last
+    # up to max_workers sources are run at the same time, sharing max_workers database connections between them,
+    #   including those of functions that take a `slots` argument (eg partitionedquery)
+    # returns a dict of source name: dataframe for the sources available, and a dataframe summarising each source
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = readmanifest(checkpoint_dir)
+    manifest_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max_workers)
+
+    counts = {}
+    run_started = time.time()
+
+    names = sorted(queries, key=lambda name: (priority or {}).get(name, 0))
+
+    def runsource(name):
+        query = queries[name]
+        source_stamp = stamp.get(name) if isinstance(stamp, dict) else stamp
+        source_stamp = None if source_stamp is None else str(source_stamp)
+        key = querykey(query)
+        path = os.path.join(checkpoint_dir, f"{name}.csv")
+        entry = manifest.get(name, {})
+
+        fresh = (
+            entry.get('status') == "ok"
+            and entry.get('key') == key
+            and entry.get('stamp') == source_stamp
+            and os.path.exists(path)
+            and (max_age is None or pd.Timestamp.now() - pd.Timestamp(entry['completed']) <= max_age)
+        )
+
+        if fresh:
+            counts[name] = pd.read_csv(path, parse_dates=['date'])
+            return dict(source=name, status="reused", rows=len(counts[name]), seconds=0.0, completed=entry['completed'], error=None)
+
+        source_timeout = timeout.get(name) if isinstance(timeout, dict) else timeout
+        source_budget = budget.get(name) if isinstance(budget, dict) else budget
+        if source_budget is not None:
+            remaining = source_budget - (time.time() - run_started)
+            if remaining <= 0:
+                return dict(source=name, status="skipped", rows=0, seconds=0.0, completed=None, error="run budget used up")
+            source_timeout = remaining if source_timeout is None else min(source_timeout, remaining)
+
+        started = time.time()
+        try:
+            if not callable(query):
+                df = readquery(dbconn, query, timeout=source_timeout, slots=slots)
+            else:
+                parameters = inspect.signature(query).parameters
+                kwargs = {'slots': slots} if 'slots' in parameters else {}
+                if source_timeout is not None and 'timeout' in parameters:
+                    kwargs['timeout'] = source_timeout
+                df = query(**kwargs)
+        except Exception as e:
+            entry = dict(status="failed", key=key, stamp=source_stamp, completed=None, error=f"{type(e).__name__}: {e}")
+        else:
+            with replacing(path) as tmp_path:
+                df.to_csv(tmp_path, index=False)
+            counts[name] = df
+            entry = dict(status="ok", key=key, stamp=source_stamp, completed=pd.Timestamp.now().isoformat(), error=None)
+
+        with manifest_lock:
+            manifest[name] = entry
+            writemanifest(checkpoint_dir, manifest)
+        return dict(
+            source=name, status="extracted" if entry['status'] == "ok" else "failed", rows=len(counts[name]) if name in counts else 0,
+            seconds=round(time.time() - started, 1), completed=entry['completed'], error=entry['error']
+        )
+
+    # sources are started in priority order, and listed in that order whichever finishes first
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summary = list(executor.map(runsource, names))
+
+    return counts, pd.DataFrame(summary, columns=['source', 'status', 'rows', 'seconds', 'completed', 'error'])
+
+
+
+def derivecounts(counts, derived):
+    # add series made by summing other series that have already been extracted, rather than querying their tables again
+    # eg derived = {"SGSS": ["SGSSpos", "SGSSneg"]} gives the daily count of all tests from the positive and negative tables,
+    # so each base table is scanned once per run instead of once for itself and again inside a UNION ALL
+    # a derived series is left out if any of its base series is unavailable
+    # returns a new dict of source name: (date, count) dataframe, including the derived series
+
+    counts = dict(counts)
+    for name, bases in derived.items():
+        if all(base in counts for base in bases):
+            counts[name] = stitchcounts([counts[base] for base in bases])
+    return counts
+
+
+
+def readcounts(store_dir, from_date=None, to_date=None, period="day"):
+    # read the daily count series saved by analysis/extract_daily_counts.py, sliced to from_date - to_date (inclusive)
+    # returns a dict of source name: (date, count) dataframe for the sources available,
+    # and the extraction summary, listing any sources that failed or were skipped
+    # stratified series are saved as csv rather than as a daily counts file, and are returned as (stratum, date, count) dataframes
+    # set period to "week" or "month" for the weekly (starting on Mondays) or monthly totals instead, where they were saved,
+    # dated on the first day of each period
+    # the counts of sampled sources are estimates, and also have the sampled, lower and upper columns of samplecounts
+
+    summary = pd.read_csv(os.path.join(store_dir, "summary.csv"))
+
+    counts = {}
+    for name in summary.loc[summary['status'].isin(["extracted", "reused", "derived"]), 'source']:
+        path = os.path.join(store_dir, f"{name}.counts")
+        if period == "day" and os.path.exists(path):
+            counts[name] = readframe(path, from_date, to_date)
+            interval_path = os.path.join(store_dir, f"{name}_interval.csv")
+            if os.path.exists(interval_path):
+                interval = pd.read_csv(interval_path, parse_dates=['date'])
+                counts[name] = counts[name].merge(interval, on='date', how='left')
+                # estimates from small sampled counts are suppressed as in samplecounts, including any saved before it did so
+                if 'sampled' in interval.columns:
+                    replaced, small = redactvalues(counts[name]['sampled'].fillna(0))
+                    counts[name]['count'] = np.where(small, replaced, counts[name]['count']).astype(np.int64)
+            continue
+        if period == "day":
+            df = pd.read_csv(os.path.join(store_dir, f"{name}.csv"), parse_dates=['date'])
+        elif os.path.exists(os.path.join(store_dir, f"{name}_periods.csv")):
+            df = pd.read_csv(os.path.join(store_dir, f"{name}_periods.csv"), parse_dates=['date'])
+            df = df[df['period'] == period].drop(columns='period')
+        else:
+            continue
+        # weeks and months are kept if any of their days are in range
+        ends = df['date'] + {"day": pd.Timedelta(0, unit='D'), "week": pd.Timedelta(6, unit='D'), "month": pd.offsets.MonthEnd(0)}[period]
+        inrange = pd.Series(True, index=df.index)
+        if from_date is not None:
+            inrange &= ends >= pd.Timestamp(from_date)
+        if to_date is not None:
+            inrange &= df['date'] <= pd.Timestamp(to_date)
+        counts[name] = df[inrange].reset_index(drop=True)
+
+    return counts, summary
@@ -0,0 +1,76 @@
+import pandas as pd
+
+from functions import countmatrix
+from disclosure import redact
+
+
+
+# A quick check of how up to date each data source is, for the database-freshness notebook.
+#
+# Rather than each source's full daily history, only its latest event date and the counts for the days just before it
+# are read. The latest date is found with MAX() on the date column itself, which an index on the column answers without
+# a scan, and the recent counts are read from the rows after it, so each source takes seconds however large it is.
+
+# the number of days counted up to each source's latest event date
+recent_days = 30
+
+# a day counts as complete if it has at least this fraction of the median daily count over the recent days
+complete_fraction = 0.5
+
+
+
+def freshnessquery(table, column, var, days=recent_days):
+    # sql for the daily count of rows in `table` for the `days` days up to its latest date in `column` that isn't in the future
+    # `var` is the date expression for `column`, eg "CONVERT(date, ConsultationDate)", as in an extraction plan
+    # the latest date and the date range are both compared with the column itself, so an index on it can be used
+
+    today = "DATEADD(day, 1, CONVERT(date, GETDATE()))"
+    query = (
+      f"""
+        SELECT {var} AS date, COUNT(*) AS count
+        FROM {table}
+        WHERE {column} >= DATEADD(day, -{days - 1}, (SELECT CONVERT(date, MAX({column})) FROM {table} WHERE {column} < {today}))
+            AND {column} < {today}
+        GROUP BY {var}
+        ORDER BY {var}
+      """
+    )
+    return query
+
+
+
+def freshnesstable(recent, run_date, days=recent_days, fraction=complete_fraction):
+    # the status of each source from its recent daily counts, a dict of source name: (date, count) dataframe from freshnessquery
+    # run with the same number of `days`
+    # returns a dataframe indexed by source with
+    #   latest: the latest event date
+    #   complete: the latest complete day, the last with at least `fraction` of the median daily count of the recent days
+    #   days_behind: days from the latest complete day to run_date
+    #   median: the median daily count over the recent days, redacted
+    # sources with no recent counts have no dates
+
+    names = list(recent)
+    recent = {name: df for name, df in recent.items() if len(df) > 0}
+    if len(recent) == 0:
+        return pd.DataFrame(columns=['latest', 'complete', 'days_behind', 'median'], index=pd.Index(names, name='source'))
+
+    # each source's own window of `days` days up to its latest date, so days outside it don't count as empty
+    latest = pd.Series({name: pd.to_datetime(df['date']).max() for name, df in recent.items()})
+    first = latest - pd.Timedelta(days - 1, unit='D')
+    matrix = countmatrix(recent, pd.DataFrame(index=pd.date_range(first.min(), latest.max(), freq="D")))
+    inwindow = (matrix.index.to_numpy()[:, None] >= first[matrix.columns].to_numpy()) & (matrix.index.to_numpy()[:, None] <= latest[matrix.columns].to_numpy())
+    windowed = matrix.where(inwindow)
+
+    median = windowed.median()
+    complete = windowed.ge(fraction * median) & inwindow
+    # the last complete day of each source: the first True from the end
+    last_complete = complete.iloc[::-1].idxmax().where(complete.any())
+
+    table = pd.DataFrame({
+        'latest': latest,
+        'complete': last_complete,
+        'days_behind': (pd.Timestamp(run_date) - last_complete).dt.days,
+        'median': redact(median)[0],
+    })
+    table.index.name = 'source'
+    return table.reindex(names).astype({'days_behind': 'Int64'})
@@ -9,6 +9,9 @@ import matplotlib.ticker as ticker
 import matplotlib.patches as patches
 from contextlib import contextmanager
 
+from eventdates import EventDates
+from disclosure import redact
+
 
 
 # use this to open connection
@@ -31,25 +34,58 @@ def closing_connection_old(server, database, username, password):
         cnxn.close()
 
 # use this to open connection
+# set timeout (seconds) to have the driver cancel any query on this connection that runs for longer
 @contextmanager
-def closing_connection(dbconn): 
+def closing_connection(dbconn, timeout=None): 
     cnxn = pyodbc.connect(dbconn)
+    if timeout is not None:
+        cnxn.timeout = max(int(timeout), 1)
     try: 
         yield cnxn 
     finally: 
         cnxn.close()
 
 
+def daycounts(days, date_range, weights=None):
+    # count events into the consecutive dates in the index of date_range
+    # where days are the offsets of each event from the first date, so events outside date_range are dropped
+    
+    inrange = (days >= 0) & (days < len(date_range.index))
+    if weights is not None:
+        weights = weights[inrange]
+    
+    counts = np.bincount(days[inrange].astype(np.int64), weights=weights, minlength=len(date_range.index))
+    if weights is None or np.issubdtype(weights.dtype, np.integer):
+        counts = counts.astype(np.int64)
+    return counts
+
+
+
+def eventdatescounts(event_dates, date_range):
+    # daily counts for each column of an EventDates, as a dataframe indexed like date_range
+    start = date_range.index[0]
+    return date_range.join(pd.DataFrame(
+        {col: daycounts(event_dates.offsets(col, start), date_range) for col in event_dates.columns},
+        index=date_range.index,
+    ))
+
+
+
 def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
     # to calculate the daily count for events recorded in a dataframe
-    # where event_dates is a dataframe of date columns
+    # where event_dates is a dataframe of date columns, or an EventDates
     # set popadjust = 1000, say, to report counts per 1000 population
     
     # initialise dataset
     counts = date_range
     
+    if isinstance(event_dates, EventDates):
+        event_cols = []
+        counts = eventdatescounts(event_dates, date_range)
+    else:
+        event_cols = event_dates
     
-    for col in event_dates:
+    for col in event_cols:
 
         # Creates a series of the entry date of the index event
         in_date = event_dates.loc[:, col]
@@ -58,14 +94,14 @@ def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
             pd.DataFrame(in_date, columns=[col]).groupby(col)[col].count().to_frame()
         )
 
-    # convert nan to zero
-    counts = counts.fillna(0)
+    # convert nan to zero, and the counts back to integers as for an EventDates
+    counts = counts.fillna(0).astype({col: np.int64 for col in event_cols})
     
     if rule != "D":
         counts = counts.resample(rule).sum()
     
     if popadjust is not False:
-        pop = event_dates.shape[0]
+        pop = len(event_dates)
         poppern = pop/popadjust
         counts = counts.transform(lambda x: x/poppern)
     
@@ -75,22 +111,44 @@ def eventcountdf(event_dates, date_range, rule='D', popadjust=False):
 
 
 def eventcountseries(event_dates, date_range, rule='D', popadjust=False):
-    # to calculate the daily count for events recorded in a series
-    # where event_dates is a series
+    # to calculate the daily count for events, over the consecutive dates in the index of date_range
+    # where event_dates is either a series of event dates (one per event, eg a patient-level date column),
+    # a single-column EventDates, or a dataframe of pre-aggregated daily counts with date and count columns (eg from datequery)
     # set popadjust = 1000, say, to report counts per 1000 population
+    # the population is the number of patients, or the total count within date_range for daily counts
     
-    pop = event_dates.size
+    index = date_range.index
+    weights = None
     
-    counts = event_dates.value_counts().reindex(date_range.index, fill_value=0)
+    if isinstance(event_dates, EventDates):
+        if len(event_dates.columns) != 1:
+            raise ValueError(f"eventcountseries needs a single-column EventDates, not one with {len(event_dates.columns)} columns; use eventcountdf")
+        name = event_dates.columns[0]
+        days = event_dates.offsets(name, index[0])
+    else:
+        if isinstance(event_dates, pd.DataFrame):
+            dates = event_dates['date']
+            weights = event_dates['count'].to_numpy()
+            name = 'count'
+        else:
+            dates = event_dates
+            name = event_dates.name
+        
+        # position of each event in date_range, by its offset in days from the first date
+        notna = dates.notna().to_numpy()
+        days = ((pd.to_datetime(dates[notna]) - index[0]) // pd.Timedelta(1, unit='D')).to_numpy()
+        if weights is not None:
+            weights = weights[notna]
     
+    counts = pd.Series(daycounts(days, date_range, weights), index=index, name=name)
     
     if rule != "D":
         counts = counts.resample(rule).sum()
     
     if popadjust is not False:
-        pop = event_dates.size
-        poppern= pop/popadjust
-        counts = counts.transform(lambda x: x/poppern)
+        pop = len(event_dates) if weights is None else counts.sum()
+        poppern = pop/popadjust
+        counts = counts / poppern
     
     return(counts)
 
@@ -98,35 +156,103 @@ def eventcountseries(event_dates, date_range, rule='D', popadjust=False):
 
 
 
-def firsteventcountdf(event_dates, date_range,  rule='D', popadjust=False):
+def groupmin(codes, values):
+    # the smallest value for each distinct code, without sorting: a hashed group-by minimum
+    # returns the distinct codes and the minimum value for each
+    mins = pd.Series(values).groupby(codes, sort=False).min()
+    return mins.index.to_numpy(), mins.to_numpy()
+
+
+
+def firstevents(patient_ids, events, dates):
+    # each patient's first date of each event, from long-format data with one row per recorded event
+    # where patient_ids, events and dates are equal-length series or arrays, eg the columns of a (patient_id, event, date) extract
+    # patients and events are matched by hashing rather than sorting, so no wide patient x event frame is built
+    # returns the distinct patient ids (in order of first appearance) and an EventDates with one row for each of them
+    # and a column for each event, which can be passed straight to eventcountdf or eventcountcmldf
+
+    dates = pd.to_datetime(pd.Series(np.asarray(dates)))
+    notna = dates.notna().to_numpy()
+
+    patient_codes, patients = pd.factorize(np.asarray(patient_ids))
+    event_codes, event_names = pd.factorize(np.asarray(events)[notna])
+
+    base_date = dates[notna].min() if notna.any() else pd.Timestamp("2000-01-01")
+    days = ((dates[notna] - base_date) // pd.Timedelta(1, unit='D')).to_numpy()
+
+    keys, first_days = groupmin(patient_codes[notna].astype(np.int64) * len(event_names) + event_codes, days)
+    rows = keys // len(event_names)
+    event_of_key = keys % len(event_names)
+
+    columns = {event: (rows[event_of_key == idx], first_days[event_of_key == idx]) for idx, event in enumerate(event_names)}
+    return patients, EventDates.from_columns(columns, len(patients), base_date)
+
+
+
+def firsteventdates(patient_ids, event_dates):
+    # each patient's first date in each column of a dataframe of date columns (or EventDates) with a row for each record
+    # returns the distinct patient ids (in order of first appearance) and an EventDates with one row for each of them
+    
+    if not isinstance(event_dates, EventDates):
+        event_dates = EventDates.from_frame(event_dates)
+    
+    patient_codes, patients = pd.factorize(np.asarray(patient_ids))
+    
+    columns = {}
+    for col in event_dates.columns:
+        rows, days = event_dates.events(col)
+        columns[col] = groupmin(patient_codes[rows], days.astype(np.int64))
+    
+    return patients, EventDates.from_columns(columns, len(patients), event_dates.base_date)
+
+
+
+def firsteventcountdf(event_dates, date_range,  rule='D', popadjust=False, patient_ids=None):
 
     # to calculate the daily number of events in a dataframe, taking first events only
     # subsequent events are excluded, for instance if a patient is admitted to ICU twice only the first admission is observed). 
+    # where event_dates is a dataframe of date columns (or an EventDates) with a row for each record,
+    # and patient_ids is the patient for each row; if it is not given, each row is taken to be a different patient
+    # with popadjust, the population is the number of distinct patients
+    # for long-format (patient, event, date) data, use firstevents and pass the result to eventcountdf
 
-    # initialise datasets
-    counts = date_range
+    if patient_ids is not None:
+        _, event_dates = firsteventdates(patient_ids, event_dates)
 
-    for idx, col in enumerate(event_dates):
+    return eventcountdf(event_dates, date_range, rule=rule, popadjust=popadjust)
 
-        # Creates a series of the entry date of the index event
-        in_date = event_dates.iloc[:, idx]
 
-        counts = counts.join(
-            pd.DataFrame(in_date, columns=[col]).groupby(col)[col].count().to_frame()
-        )
 
-    # convert nan to zero
-    counts = counts.fillna(0)
+def eventdatescmlcounts(event_dates, date_range):
+    # daily numbers entering and leaving each state, as in eventcountcmldf, for an EventDates
+    # each patient's days are compared as integer offsets, and the earliest later event is carried back column by column
 
-    if rule != "D":
-        counts = counts.resample(rule).sum()
-    
-    if popadjust is not False:
-        pop = event_dates.shape[0]
-        poppern= pop/popadjust
-        counts = counts.transform(lambda x: x/poppern)
+    start = date_range.index[0]
+    missing = np.iinfo(np.int64).max
+    cols = event_dates.columns
 
-    return(counts)
+    in_counts = {}
+    out_counts = {}
+    later = np.full(len(event_dates), missing)
+
+    for idx in reversed(range(len(cols))):
+        in_day = event_dates.dense(cols[idx], start, missing)
+        if idx == len(cols) - 1:
+            # the day after date_range ends, so is never counted
+            out_day = np.full(len(event_dates), len(date_range.index))
+        else:
+            out_day = later
+
+        # ignores entries where a more advanced event occurs at an earlier date
+        keep = (in_day != missing) & (in_day <= out_day)
+        in_counts[cols[idx]] = daycounts(in_day[keep], date_range)
+        out_counts[cols[idx]] = daycounts(out_day[keep & (out_day != missing)], date_range)
+
+        later = np.minimum(later, in_day)
+
+    in_counts = date_range.join(pd.DataFrame(in_counts, index=date_range.index)[cols])
+    out_counts = date_range.join(pd.DataFrame(out_counts, index=date_range.index)[cols])
+    return in_counts, out_counts
 
 
 
@@ -143,8 +269,13 @@ def eventcountcmldf(event_dates, date_range, rule = "D", popadjust=False):
     in_counts = date_range
     out_counts = date_range
    
+    if isinstance(event_dates, EventDates):
+        event_cols = []
+        in_counts, out_counts = eventdatescmlcounts(event_dates, date_range)
+    else:
+        event_cols = event_dates
 
-    for idx, col in enumerate(event_dates):
+    for idx, col in enumerate(event_cols):
 
         # Creates a series of the entry date of the index event
         in_date = event_dates.iloc[:, idx]
@@ -182,7 +313,7 @@ def eventcountcmldf(event_dates, date_range, rule = "D", popadjust=False):
         net_counts = net_counts.resample(rule).sum()
     
     if popadjust is not False:
-        pop = event_dates.shape[0]
+        pop = len(event_dates)
         poppern = pop/popadjust
         net_counts = net_counts.transform(lambda x: x/poppern)
 
@@ -193,27 +324,299 @@ def eventcountcmldf(event_dates, date_range, rule = "D", popadjust=False):
 
 
 
+def cmlcountsfromdeltas(deltas, date_range, states, rule="D"):
+    # the counts returned by eventcountcmldf, for each stratum, from the (stratum, date, state, delta) rows of a cmlstatequery
+    # returns a dict of stratum: net counts dataframe, with a column for each of states (a list of state names) in order
+
+    deltas = deltas.assign(date=pd.to_datetime(deltas['date']))
+    wide = deltas.pivot_table(index=['stratum', 'date'], columns='state', values='delta', aggfunc='sum', fill_value=0)
+    wide = wide.reindex(columns=states, fill_value=0)
+
+    net_counts = {}
+    for strat, strat_deltas in wide.groupby(level='stratum', sort=True):
+        counts = strat_deltas.droplevel('stratum').reindex(date_range.index, fill_value=0).cumsum()
+        counts.columns.name = None
+        if rule != "D":
+            counts = counts.resample(rule).sum()
+        net_counts[strat] = counts.astype(float)
+
+    return net_counts
+
+
+
+
+
+def statetransitions(event_dates, date_range, max_dwell=90):
+    # daily flows between ordered states, and the time spent in each state before moving on
+    # where event_dates is a dataframe of date columns (or an EventDates) with a row per patient, and the columns are
+    # states in order of advancement (eg test, A&E, admission, ICU, death), as for eventcountcmldf
+    # as in eventcountcmldf, an event is ignored if a more advanced event happened earlier, so each patient's path
+    # moves forwards through the states, and a move from one state to the next is counted on the day the next starts
+    # the columns are visited once in order, with the patient's current state and its start day carried along as arrays
+    # returns:
+    #   flows, a dataframe indexed like date_range with a column for each (from, to) pair of states, where from is
+    #   "start" for a patient's first state
+    #   dwell, a dataframe of the number of patients moving on after spending 0, 1, 2, ... days in each state (column),
+    #   for moves within date_range, with max_dwell counting any stay of max_dwell days or more; stays that have not ended are not counted
+
+    if not isinstance(event_dates, EventDates):
+        event_dates = EventDates.from_frame(event_dates)
+
+    start = date_range.index[0]
+    ndays = len(date_range.index)
+    missing = np.iinfo(np.int64).max
+    cols = event_dates.columns
+    nstates = len(cols)
+    nrows = len(event_dates)
+
+    # whether each event is on the patient's path, ie no more advanced event happened before it
+    onpath = np.zeros((nrows, nstates), dtype=bool)
+    later = np.full(nrows, missing)
+    for idx in reversed(range(nstates)):
+        day = event_dates.dense(cols[idx], start, missing)
+        onpath[:, idx] = (day != missing) & (day <= later)
+        later = np.minimum(later, day)
+    del later
+
+    # state -1 is "start", before the patient's first event
+    current_state = np.full(nrows, -1, dtype=np.int64)
+    current_day = np.full(nrows, missing)
+    flows = np.zeros((nstates + 1) * nstates * ndays, dtype=np.int64)
+    dwell = np.zeros(nstates * (max_dwell + 1), dtype=np.int64)
+
+    for idx in range(nstates):
+        moving = onpath[:, idx]
+        day = event_dates.dense(cols[idx], start, missing)[moving]
+        from_state = current_state[moving]
+        inrange = (day >= 0) & (day < ndays)
+
+        flows += np.bincount(
+            ((from_state[inrange] + 1) * nstates + idx) * ndays + day[inrange], minlength=len(flows)
+        )
+
+        stayed = inrange & (from_state >= 0)
+        days_in_state = np.minimum(day[stayed] - current_day[moving][stayed], max_dwell)
+        dwell += np.bincount(from_state[stayed] * (max_dwell + 1) + days_in_state, minlength=len(dwell))
+
+        current_state[moving] = idx
+        current_day[moving] = day
+
+    names = ["start"] + list(cols)
+    flows = pd.DataFrame(
+        flows.reshape((nstates + 1) * nstates, ndays).T,
+        index=date_range.index,
+        columns=pd.MultiIndex.from_product([names, cols], names=['from', 'to']),
+    )
+    # only forward moves are possible
+    flows = flows.loc[:, [names.index(a) < names.index(b) for a, b in flows.columns]]
+
+    dwell = pd.DataFrame(dwell.reshape(nstates, max_dwell + 1).T, columns=cols)
+    dwell.index.name = 'days'
+
+    return flows, dwell
+
+
+
+def occupancydeltas(start_dates, end_dates, date_range, strata_codes=None, nstrata=1, include_end=True):
+    # the number of patients entering (+1) and leaving (-1) a state on each day of date_range, for each stratum
+    # where start_dates and end_dates are equal-length series of the dates each patient enters and leaves the state
+    # (eg APCS admission and discharge dates), and strata_codes is an optional integer stratum (0 to nstrata-1) for each
+    # patients with no end date are still in the state at the end of date_range; those with no start date are ignored
+    # if include_end is True a patient is counted on their end date (eg the day of discharge), otherwise only up to the day before
+    # returns an array of shape (nstrata, number of days + 1), whose cumulative sum along each row is the daily occupancy
+
+    index = date_range.index
+    ndays = len(index)
+
+    start = pd.to_datetime(pd.Series(np.asarray(start_dates)))
+    end = pd.to_datetime(pd.Series(np.asarray(end_dates)))
+
+    start_day = ((start - index[0]) // pd.Timedelta(1, unit='D')).to_numpy(dtype=float)
+    exit_day = ((end - index[0]) // pd.Timedelta(1, unit='D')).to_numpy(dtype=float) + (1 if include_end else 0)
+    exit_day[np.isnan(exit_day)] = ndays
+
+    # keep stays with a start date that overlap date_range, and clip them to it
+    valid = ~np.isnan(start_day) & (exit_day > start_day) & (exit_day > 0) & (start_day < ndays)
+    start_day = np.clip(start_day[valid], 0, ndays).astype(np.int64)
+    exit_day = np.clip(exit_day[valid], 0, ndays).astype(np.int64)
+
+    offset = 0 if strata_codes is None else np.asarray(strata_codes)[valid].astype(np.int64) * (ndays + 1)
+    size = nstrata * (ndays + 1)
+
+    deltas = np.bincount(offset + start_day, minlength=size) - np.bincount(offset + exit_day, minlength=size)
+    return deltas.reshape(nstrata, ndays + 1)
+
+
+
+def occupancyframe(deltas, date_range, columns, rule="D"):
+    # turn an array of daily deltas from occupancydeltas into a dataframe of daily occupancy, with a column for each stratum
+    # occupancy is a level rather than a count, so for rule != "D" the mean daily occupancy in each period is reported
+
+    occupancy = pd.DataFrame(np.cumsum(deltas, axis=1)[:, :-1].T, index=date_range.index, columns=columns)
+    if rule != "D":
+        occupancy = occupancy.resample(rule).mean()
+    return occupancy
+
+
+
+def occupancycountdf(start_dates, end_dates, date_range, strata=None, include_end=True, rule="D", popadjust=False):
+    # to calculate the number of patients in a state (eg in hospital, or on a treatment) on each day
+    # from interval data: a start and end date for each stay, eg APCS Admission_Date and Discharge_Date
+    # each stay adds +1 on its start day and -1 after its end day, and the running total is the daily occupancy,
+    # so the cost is proportional to the number of stays plus the number of days, with no filtering per day
+    # set strata to a series of categories (eg region) for one column per stratum, otherwise there is a single 'occupancy' column
+    # set popadjust = 1000, say, to report occupancy per 1000 stays (in each stratum)
+
+    if strata is None:
+        codes, columns = None, ['occupancy']
+        pop = np.array([len(start_dates)])
+    else:
+        codes, columns = pd.factorize(np.asarray(strata), sort=True)
+        pop = np.bincount(codes[codes >= 0], minlength=len(columns))
+        # stays with no stratum are not counted
+        keep = codes >= 0
+        start_dates = np.asarray(start_dates)[keep]
+        end_dates = np.asarray(end_dates)[keep]
+        codes = codes[keep]
+
+    deltas = occupancydeltas(start_dates, end_dates, date_range, codes, len(columns), include_end=include_end)
+    occupancy = occupancyframe(deltas, date_range, list(columns), rule=rule)
+
+    if popadjust is not False:
+        occupancy = occupancy / (pop/popadjust)
+
+    return(occupancy)
+
+
+
+def occupancychunks(chunks, date_range, start, end, strata=None, include_end=True, rule="D"):
+    # as occupancycountdf, for stays that arrive in chunks, eg pd.read_sql(query, cnxn, chunksize=1000000),
+    # so full APCS volumes never need to be held in memory at once
+    # where start, end and (optionally) strata are the names of the columns in each chunk
+    # only the daily deltas for each stratum are kept between chunks
+
+    deltas = {}
+    for chunk in chunks:
+        if strata is None:
+            chunk_deltas = occupancydeltas(chunk[start], chunk[end], date_range, include_end=include_end)
+            deltas['occupancy'] = deltas.get('occupancy', 0) + chunk_deltas[0]
+            continue
+
+        codes, names = pd.factorize(chunk[strata])
+        keep = codes >= 0
+        chunk_deltas = occupancydeltas(
+            chunk[start][keep], chunk[end][keep], date_range, codes[keep], len(names), include_end=include_end
+        )
+        for idx, name in enumerate(names):
+            deltas[name] = deltas.get(name, 0) + chunk_deltas[idx]
+
+    columns = sorted(deltas)
+    if len(columns) == 0:
+        return occupancyframe(np.zeros((0, len(date_range.index) + 1), dtype=np.int64), date_range, columns, rule=rule)
+    return occupancyframe(np.vstack([deltas[name] for name in columns]), date_range, columns, rule=rule)
+
+
+
+def countmatrix(counts, date_range, rule="D"):
+    # a (date x source) matrix of counts from a dict of source name: (date, count) dataframe, eg from readcounts
+    # indexed like date_range (resampled to `rule`), with a column for each source, so all sources can be redacted in one pass
+    # an empty dict gives a matrix with no columns, eg if every source failed
+
+    if len(counts) == 0:
+        matrix = pd.DataFrame(index=date_range.index, dtype=np.int64)
+        return matrix.resample(rule).sum() if rule != "D" else matrix
+
+    long = pd.concat([df[['date', 'count']].assign(source=name) for name, df in counts.items()], ignore_index=True)
+    long['date'] = pd.to_datetime(long['date'])
+    matrix = long.pivot_table(index='date', columns='source', values='count', aggfunc='sum', fill_value=0)
+    matrix = matrix.reindex(index=date_range.index, columns=list(counts), fill_value=0)
+    matrix.columns.name = None
+
+    if rule != "D":
+        matrix = matrix.resample(rule).sum()
+    return matrix
+
+
+
+def sampleinterval(df, date_range):
+    # the daily lower and upper bounds of a sampled source's estimated counts (from samplecounts, eg via readcounts),
+    # indexed like date_range and redacted like the counts, or None if the source was counted in full
+    # days whose sampled count is small are redacted by the sampled count, as the bounds are only that count scaled up
+
+    if 'lower' not in df.columns:
+        return None
+    bounds = df.set_index(pd.to_datetime(df['date']))[['lower', 'upper']]
+    if 'sampled' in df.columns:
+        _, small = redact(df.set_index(pd.to_datetime(df['date']))['sampled'].fillna(0))
+        bounds = bounds.mask(small, 0)
+    bounds, _ = redact(bounds.reindex(date_range.index).fillna(0))
+    return bounds['lower'], bounds['upper']
+
+
+
+def stratacountdf(counts, date_range, rule="D"):
+    # daily counts for each stratum from pre-aggregated (stratum, date, count) dataframes, eg from a stratified datequery
+    # counts is either one such dataframe, or a dict of source name: dataframe
+    # returns a dict of stratum: dataframe indexed like date_range, with a column for each source (or a single count column)
+
+    if isinstance(counts, pd.DataFrame):
+        counts = {'count': counts}
+    long = pd.concat([df.assign(source=name) for name, df in counts.items()], ignore_index=True)
+    long['date'] = pd.to_datetime(long['date'])
+    wide = long.pivot_table(index=['stratum', 'date'], columns='source', values='count', aggfunc='sum', fill_value=0)
+    wide = wide.reindex(columns=list(counts), fill_value=0)
+
+    strata_counts = {}
+    for strat, strat_counts in wide.groupby(level='stratum', sort=True):
+        count_cat = strat_counts.droplevel('stratum').reindex(date_range.index, fill_value=0)
+        count_cat.columns.name = None
+        if rule != "D":
+            count_cat = count_cat.resample(rule).sum()
+        strata_counts[strat] = count_cat
+
+    return strata_counts
+
 
 
 def eventcounts_strata_plot(df, date_range, date_cols, var, panelheight=5, panelwidth=5, gridcols=1, rule = "D", popadjust=False):
     #### Plot event counts stratified by a categorical variable
-
-    event_dates = df.filter(items=date_cols + [var])
-    strata = sorted(event_dates[var].unique())
+    # df can also be an EventDates, with var the stratum of each of its rows (eg a column of the patient dataframe)
+    # or pre-aggregated (stratum, date, count) dataframes from a stratified datequery, either one dataframe (with date_cols = ['count'])
+    # or a dict of source name: dataframe (with date_cols the sources to plot), and var unused
+
+    aggregated = isinstance(df, dict) or (isinstance(df, pd.DataFrame) and {'stratum', 'date', 'count'} <= set(df.columns))
+
+    if aggregated:
+        if popadjust is not False:
+            raise ValueError("popadjust needs patient-level dates, as the size of each stratum is not returned by datequery")
+        strata_counts = stratacountdf(df, date_range, rule = "D")
+        strata = sorted(strata_counts)
+    elif isinstance(df, EventDates):
+        strata_values = np.asarray(var)
+        strata = sorted(pd.unique(strata_values))
+    else:
+        event_dates = df.filter(items=date_cols + [var])
+        strata = sorted(event_dates[var].unique())
     
     gridrows = int(np.ceil(len(strata)/gridcols))
     
     figsize = (panelwidth*gridcols, panelheight*gridrows)
 
-    fig, axs = plt.subplots(gridrows, gridcols, figsize=figsize, sharey='all', sharex='all')
+    fig, axs = plt.subplots(gridrows, gridcols, figsize=figsize, sharey='all', sharex='all', squeeze=False)
      
     for i, strat in enumerate(strata):
           
         col=i % gridcols
         row=np.floor(i / gridcols).astype("int")
             
-        events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)
-        count_cat = eventcountdf(events_cat, date_range, rule = "D", popadjust=popadjust)
+        if aggregated:
+            count_cat = strata_counts[strat]
+        else:
+            if isinstance(df, EventDates):
+                events_cat = df.subset(strata_values == strat)
+            else:
+                events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)
+            count_cat = eventcountdf(events_cat, date_range, rule = "D", popadjust=popadjust)
        
        # axs[row, col] = plt.subplot(gs[i % gridrows, np.floor(i / gridrows).astype("int")])
         for l in date_cols:
@@ -237,9 +640,24 @@ def eventcounts_strata_plot(df, date_range, date_cols, var, panelheight=5, panel
 def cmlinc_strata_plot(df, date_cols, var, date_range, panelheight=5, panelwidth=5, gridcols=1, popadjust=False):
     
     #### Plot cumulative event counts stratified by a categorical variable
-
-    event_dates = df.filter(items=date_cols + [var])
-    strata = sorted(event_dates[var].unique())
+    # df can also be an EventDates, with var the stratum of each of its rows (eg a column of the patient dataframe)
+    # or the (stratum, date, state, delta) result of a cmlstatequery, with date_cols the state names in order and var unused
+
+    aggregated = isinstance(df, pd.DataFrame) and {'stratum', 'date', 'state', 'delta'} <= set(df.columns)
+
+    if aggregated:
+        if popadjust is not False:
+            raise ValueError("popadjust needs patient-level dates, as the size of each stratum is not returned by cmlstatequery")
+        net_counts = cmlcountsfromdeltas(df, date_range, date_cols)
+        strata = sorted(net_counts)
+    elif isinstance(df, EventDates):
+        strata_values = np.asarray(var)
+        strata = sorted(pd.unique(strata_values))
+        anyevent = pd.Series(df.anyevent()).groupby(strata_values)
+    else:
+        event_dates = df.filter(items=date_cols + [var])
+        strata = sorted(event_dates[var].unique())
+        anyevent = event_dates.filter(items=date_cols).notna().any(axis=1).groupby(event_dates[var])
     
     gridrows = int(np.ceil(len(strata)/gridcols))
     
@@ -250,14 +668,22 @@ def cmlinc_strata_plot(df, date_cols, var, date_range, panelheight=5, panelwidth
     gs = gridspec.GridSpec(gridrows,gridcols)  # grid layout for subplots (rows, cols)
 
         
-    if popadjust==False:
-        maxy = event_dates.filter(items=date_cols).notna().any(axis=1).groupby(event_dates[var]).sum().max() * 1.05
+    if aggregated:
+        maxy = max(counts.sum(axis=1).max() for counts in net_counts.values()) * 1.05
+    elif popadjust==False:
+        maxy = anyevent.sum().max() * 1.05
     else:
-        maxy = event_dates.filter(items=date_cols).notna().any(axis=1).groupby(event_dates[var]).mean().max() * 1.05 * popadjust
+        maxy = anyevent.mean().max() * 1.05 * popadjust
         
     for i, strat in enumerate(strata):
-        events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)            
-        cmlinc_cat = eventcountcmldf(events_cat, date_range, popadjust=popadjust)
+        if aggregated:
+            cmlinc_cat = net_counts[strat]
+        else:
+            if isinstance(df, EventDates):
+                events_cat = df.subset(strata_values == strat)
+            else:
+                events_cat = (event_dates[event_dates[var] == strat]).drop(var, 1)            
+            cmlinc_cat = eventcountcmldf(events_cat, date_range, popadjust=popadjust)
        
         ax = plt.subplot(gs[np.floor(i / gridcols).astype("int"), i % gridcols])
         ax.stackplot(cmlinc_cat.index, cmlinc_cat.to_numpy().transpose(), labels=cmlinc_cat.columns)
@@ -290,12 +716,11 @@ def plotcounts(date_range, events=None, title="", lookback=30):
         
         lastcounts = counts.loc[(counts.index >= lastdaterecent) & (counts.index <= lastdate)]
 
-        redact = (lastcounts <6) & (lastcounts>0)
-        lastcounts = lastcounts.where(~redact, 2.5) #redact small numbers
+        lastcounts, redacted = redact(lastcounts, replace=2.5) #redact small numbers
         
-        return counts, lastcounts, redact
+        return counts, lastcounts, redacted
     
-    counts, lastcounts, redact = createcounts(date_range, events, lastdate)
+    counts, lastcounts, redacted = createcounts(date_range, events, lastdate)
     
    # xlimlower = mdates.date2num(lastcounts.index[0]+pd.DateOffset(days=-1))
    # xlimupper = mdates.date2num(lastcounts.index[-1]+pd.DateOffset(days=+1))
@@ -303,7 +728,7 @@ def plotcounts(date_range, events=None, title="", lookback=30):
     fig, axs = plt.subplots(1, 2, figsize=(15,5))
     
     axs[1].plot(lastcounts.index, lastcounts, label=events.name, marker='o', markersize=5, color='darkblue', zorder=1)
-    axs[1].plot(lastcounts[redact].index, lastcounts[redact], 'o', linestyle = 'None', color='tomato', zorder=2)
+    axs[1].plot(lastcounts[redacted].index, lastcounts[redacted], 'o', linestyle = 'None', color='tomato', zorder=2)
     axs[1].xaxis.set_tick_params(labelrotation=70)
     axs[1].xaxis.set_major_locator(ticker.MultipleLocator(2))
     axs[1].set_ylim(bottom=0)
@@ -352,13 +777,9 @@ def plotcounts_history(events=None, title=""):
     enddatestring = enddate.strftime('%Y-%m-%d')
     
 
-    counts_day = eventcountseries(events, date_range, rule="D")
-    redact_day = (counts_day <6) & (counts_day>0)
-    counts_day = counts_day.where(~redact_day, 2.5) #redact small numbers
+    counts_day, _ = redact(eventcountseries(events, date_range, rule="D"), replace=2.5) #redact small numbers
     
-    counts_week = eventcountseries(events, date_range, rule="W")
-    redact_week = (counts_week <6) & (counts_week>0)
-    counts_week = counts_week.where(~redact_week, 2.5) #redact small numbers
+    counts_week, _ = redact(eventcountseries(events, date_range, rule="W"), replace=2.5) #redact small numbers
        
     fig, axs = plt.subplots(1, 1, figsize=(15,5))
     
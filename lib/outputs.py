@@ -0,0 +1,32 @@
+import os
+from contextlib import contextmanager
+
+
+
+# Writing the outputs that later runs read back.
+#
+# Some outputs are also read by later runs of the action that wrote them: the extraction checkpoints and partitions
+# (see lib/extraction.py), the daily counts files, which are appended to (lib/dailystore.py), the vintages of the daily
+# counts (lib/vintages.py), the data quality profiles of earlier builds (analysis/profile_tables.py), and the schema
+# snapshots and html cache (lib/schema.py). The job runner starts every action with only the code and the outputs of
+# the actions it needs, never the action's own earlier outputs, so under `opensafely run` each run finds none of them.
+# It then extracts and profiles every table in full, keeps a single vintage, profile and snapshot, and the notebooks
+# say that there is no earlier build or schema to compare with.
+#
+# Every such output is written with `replacing` (or, for an appended daily counts file, has its header updated only
+# once the new days are written), so a run that is interrupted never leaves a partial file that a later run would read
+# back as complete.
+
+
+
+@contextmanager
+def replacing(path):
+    # a temporary path to write `path` to, which replaces `path` only once the write has completed
+    # the temporary file is removed if the write fails
+    tmp_path = path + ".tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,185 @@
+import os
+import pandas as pd
+from functools import partial
+
+from extraction import periodquery, partitionedquery, readsample
+
+
+
+# Extraction plans generated from OpenSAFELYSchemaInformation.
+#
+# Rather than hand-writing the table and date column for every source, each table's event date column is picked from
+# its date and datetime columns by the rules below, so every table with a date gets a daily count series, including
+# tables added after this was written. The rules can be overridden for individual tables in `overrides`.
+
+# column types that hold a date; columns of any other date type are converted to dates so that counts are daily
+date_types = ["date", "datetime", "datetime2", "smalldatetime", "datetimeoffset"]
+
+# date columns that describe the patient or the data processing rather than when an event happened
+ignored_columns = r"birth|dob|build|import|ingest|load|process|updated|modified|created|refresh|expir"
+
+# when a table has more than one candidate date column, the first of these patterns that matches picks the column,
+# then the column position breaks any tie
+preferred_columns = [
+    r"admission", r"arrival", r"specimen", r"appointment", r"consultation", r"event", r"seen",
+    r"death|dod", r"treatment", r"start", r"date$", r"date",
+]
+
+# table: None to leave a table out, or a dict of
+#   name: the source name its counts are saved under (default the table name)
+#   column: its event date column, rather than the one the rules would pick
+#   partitioned: True to extract it a month at a time in parallel (default if it has more than partition_rows rows)
+#   sample: the fraction of rows to count, eg 0.01, for approximate counts with confidence intervals in a fraction of the
+#     time (default None, count every row), and sampling: how to sample them, "patient" (default) or "pages";
+#     see extraction.sampleclause
+overrides = {
+    "CodedEvent": dict(column="ConsultationDate", partitioned=True),
+    "Appointment": dict(column="SeenDate", partitioned=True),
+    "APCS": dict(column="Admission_Date"),
+    "CPNS": dict(column="DateOfDeath"),
+    "EC": dict(column="Arrival_Date"),
+    "ICNARC": dict(column="IcuAdmissionDateTime"),
+    "ONS_Deaths": dict(name="ONS", column="dod"),
+    "OPA": dict(column="Appointment_Date"),
+    "SGSS_Positive": dict(name="SGSSpos", column="Earliest_Specimen_Date"),
+    "SGSS_Negative": dict(name="SGSSneg", column="Earliest_Specimen_Date"),
+    "SGSS_AllTests_Positive": dict(name="SGSSpos_all", column="Specimen_Date"),
+    "SGSS_AllTests_Negative": dict(name="SGSSneg_all", column="Specimen_Date"),
+    "Therapeutics": dict(column="TreatmentStartDate"),
+    # describe patients and practices rather than events, and fill the dates of those still to come with placeholders,
+    # eg a DateOfDeath of 9999-12-31 for living patients
+    "Patient": None,
+    "Organisation": None,
+    # metadata rather than events
+    "BuildInfo": None,
+    "LatestBuildTime": None,
+    "OpenSAFELYSchemaInformation": None,
+}
+
+# tables with more rows than this (from table_size_query) are extracted a month at a time
+partition_rows = 500_000_000
+
+
+
+def datecolumn(columns):
+    # the event date column of one table, from its rows of the schema, and the rule that picked it
+    # returns (None, reason) if the table has no suitable date column
+
+    dates = columns[columns['ColumnType'].str.lower().isin(date_types)]
+    if len(dates) == 0:
+        return None, "no date columns"
+
+    candidates = dates[~dates['ColumnName'].str.contains(ignored_columns, case=False, regex=True)]
+    if len(candidates) == 0:
+        return None, "only non-event date columns"
+    if len(candidates) == 1:
+        return candidates['ColumnName'].iloc[0], "only date column"
+
+    position = pd.to_numeric(candidates['ColumnId'], errors='coerce')
+    for pattern in preferred_columns:
+        matches = candidates['ColumnName'].str.contains(pattern, case=False, regex=True)
+        if matches.any():
+            return candidates.loc[position[matches].idxmin(), 'ColumnName'], f"matches '{pattern}'"
+    return candidates.loc[position.idxmin(), 'ColumnName'], "first date column"
+
+
+
+def extractionplan(table_schema, sizes=None, overrides=overrides):
+    # the extraction plan for every table in the schema, as a dataframe with a row per table and the columns
+    #   name, table, column, type, var (the date expression for datequery), rule (why the column was picked),
+    #   partitioned, sample and sampling, and included (False for tables left out or without a date column)
+    # sizes is the optional result of table_size_query, used to partition the largest tables
+    # overridden tables are listed first, in the order of `overrides`, then the rest by table name
+
+    # tables with no DataSource aren't listed in the schema notebook either
+    schema = table_schema[table_schema['DataSource'].notna() & (table_schema['DataSource'] != "")]
+    schema = schema[['TableName', 'ColumnName', 'ColumnType', 'ColumnId']].astype(str)
+    plan = []
+
+    for table, columns in schema.groupby('TableName', sort=True):
+        override = overrides.get(table, {})
+        if table in overrides and override is None:
+            plan.append(dict(name=table, table=table, column=None, type=None, rule="left out", partitioned=False, sample=None, sampling=None))
+            continue
+
+        if 'column' in override:
+            column, rule = override['column'], "override"
+        else:
+            column, rule = datecolumn(columns)
+
+        column_type = columns.loc[columns['ColumnName'] == column, 'ColumnType']
+        column_type = column_type.iloc[0].lower() if len(column_type) > 0 else None
+        if column is not None and column_type is None:
+            rule = f"{rule}, but {column} is not in the schema"
+
+        table_rows = None if sizes is None else sizes.loc[sizes['TableName'] == table, 'Rows'].max()
+        large = pd.notna(table_rows) and table_rows > partition_rows
+
+        plan.append(dict(
+            name=override.get('name', table), table=table, column=column, type=column_type, rule=rule,
+            partitioned=override.get('partitioned', large),
+            sample=override.get('sample'), sampling=override.get('sampling', "patient") if 'sample' in override else None,
+        ))
+
+    plan = pd.DataFrame(plan, columns=['name', 'table', 'column', 'type', 'rule', 'partitioned', 'sample', 'sampling'])
+    plan['included'] = plan['type'].notna()
+    plan['var'] = [
+        None if not included else column if column_type == "date" else f"CONVERT(date, {column})"
+        for included, column, column_type in zip(plan['included'], plan['column'], plan['type'])
+    ]
+
+    order = {table: i for i, table in enumerate(overrides)}
+    plan['_order'] = plan['table'].map(order).fillna(len(order))
+    plan = plan.sort_values(['_order', 'table'], kind='stable').drop(columns='_order').reset_index(drop=True)
+    return plan[['name', 'table', 'column', 'type', 'var', 'rule', 'partitioned', 'sample', 'sampling', 'included']]
+
+
+
+def planqueries(plan, dbconn, from_date, to_date, partition_dir, periods=("day", "week", "month"), partition_timeout=None):
+    # the query for each included table in an extraction plan, for extractsources
+    # every table is counted from from_date up to to_date, a date or a dict of them by source name, so placeholder dates
+    # far in the future are left out; partitioned tables are extracted a month at a time, saving each month under
+    # partition_dir/to_date/name, and cancelling any month that runs for longer than partition_timeout (seconds)
+    # sampled tables return estimated counts, with the columns added by samplecounts
+
+    queries = {}
+    for row in plan[plan['included']].itertuples():
+        # unsampled queries are made without the sample arguments, so their checkpoints are still valid
+        sample = {} if pd.isna(row.sample) else dict(sample=float(row.sample), sampling=row.sampling)
+        source_to_date = to_date[row.name] if isinstance(to_date, dict) else to_date
+        if row.partitioned:
+            # sampled partitions are saved apart from unsampled ones, and those of other sampling rates
+            partition_name = f"{row.name}_{row.sampling}{row.sample:g}" if sample else row.name
+            queries[row.name] = partial(
+                partitionedquery, dbconn, row.table, row.var, from_date, source_to_date,
+                freq="MS", partition_dir=os.path.join(partition_dir, source_to_date, partition_name), periods=periods,
+                partition_timeout=partition_timeout, **sample
+            )
+        elif sample:
+            queries[row.name] = partial(readsample, dbconn, periodquery(row.table, row.var, from_date, source_to_date, periods=periods, **sample), **sample)
+        else:
+            queries[row.name] = periodquery(row.table, row.var, from_date, source_to_date, periods=periods)
+    return queries
+
+
+
+def readplan(store_dir):
+    # the extraction plan saved to a daily counts store by analysis/extract_daily_counts.py
+    # returns an empty plan for stores extracted before plans were saved
+
+    path = os.path.join(store_dir, "plan.csv")
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['name', 'table', 'column', 'type', 'var', 'rule', 'partitioned', 'sample', 'sampling', 'included'])
+    return pd.read_csv(path)
+
+
+
+def plantitles(plan, counts, titles):
+    # a plot title for each source in counts that was found in the schema, rather than listed in `overrides` or
+    # given one of `titles`, in the order of the plan, eg {"HighCostDrugs": "HighCostDrugs (DrugSupplyDate)"}
+
+    found = plan[
+        plan['included'].astype(bool) & ~plan['table'].isin(list(overrides))
+        & ~plan['name'].isin(list(titles)) & plan['name'].isin(list(counts))
+    ]
+    return {name: f"{table} ({column})" for name, table, column in zip(found['name'], found['table'], found['column'])}
@@ -0,0 +1,152 @@
+import os
+import pandas as pd
+
+from planner import date_types
+
+
+
+# Data quality profiles of each table, from one generated query per table.
+#
+# Rather than a query per measure and column, each table's profile is a single aggregate SELECT over the table, with
+# an expression per measure per column, so the whole table is scanned once however many columns it has. The
+# expressions are generated from the column types in OpenSAFELYSchemaInformation.
+#
+# Each build's profiles are saved in their own directory, so changes in data quality between builds can be reported.
+
+# dates before this are before the OpenSAFELY-TPP primary care records start, so are likely to be placeholders or errors
+earliest_date = "2009-01-01"
+
+# column types that APPROX_COUNT_DISTINCT and comparisons don't support
+unsupported_types = ["text", "ntext", "image", "xml", "sql_variant", "geography", "geometry", "hierarchyid"]
+
+# column types that COUNT_BIG(column) doesn't accept, so their nulls are counted with a CASE instead
+uncountable_types = ["text", "ntext", "image"]
+
+# the measures in a profile, for each column
+measures = ['rows', 'nulls', 'null_rate', 'distinct', 'min', 'max', 'future', 'pre2009']
+
+# the columns of profiledrift
+drift_columns = ['null_rate_previous', 'null_rate', 'future', 'pre2009', 'min_previous', 'min', 'max_previous', 'max', 'change']
+
+
+
+def profilequery(table, columns):
+    # sql for the profile of one table, from its rows of OpenSAFELYSchemaInformation, returning a single row
+    # every column gets a null count and (for types that support it) an approximate distinct count; date columns also
+    # get their earliest and latest dates and counts of dates after today and before earliest_date
+    # measures are named c{i}_{measure}, for the i'th of `columns`, as column names needn't be valid aliases
+    # every count is a COUNT_BIG, as SUM and COUNT return an int, which overflows for tables of more than 2^31 rows
+
+    expressions = ["COUNT_BIG(*) AS [rows]"]
+    for i, (column, column_type) in enumerate(zip(columns['ColumnName'], columns['ColumnType'].str.lower())):
+        var = f"[{column.replace(']', ']]')}]"
+        if column_type in uncountable_types:
+            expressions.append(f"COUNT_BIG(CASE WHEN {var} IS NULL THEN 1 END) AS [c{i}_nulls]")
+        else:
+            expressions.append(f"COUNT_BIG(*) - COUNT_BIG({var}) AS [c{i}_nulls]")
+        if column_type not in unsupported_types:
+            expressions.append(f"APPROX_COUNT_DISTINCT({var}) AS [c{i}_distinct]")
+        if column_type in date_types:
+            expressions += [
+                f"MIN(CONVERT(date, {var})) AS [c{i}_min]",
+                f"MAX(CONVERT(date, {var})) AS [c{i}_max]",
+                f"COUNT_BIG(CASE WHEN CONVERT(date, {var}) > CONVERT(date, GETDATE()) THEN 1 END) AS [c{i}_future]",
+                f"COUNT_BIG(CASE WHEN {var} < CONVERT(date, '{earliest_date}') THEN 1 END) AS [c{i}_pre2009]",
+            ]
+
+    select = ",\n            ".join(expressions)
+    query = (
+      f"""
+        SELECT
+            {select}
+        FROM {table}
+      """
+    )
+    return query
+
+
+
+def profileframe(table, columns, result):
+    # the one-row result of profilequery as a dataframe with a row per column of the table, and a column per measure
+    # measures that don't apply to a column's type are missing
+
+    result = result.iloc[0]
+    rows = int(result['rows'])
+    profile = pd.DataFrame({
+        'table': table,
+        'column': columns['ColumnName'].to_numpy(),
+        'type': columns['ColumnType'].to_numpy(),
+        'rows': rows,
+    })
+    for measure in ['nulls', 'distinct', 'min', 'max', 'future', 'pre2009']:
+        profile[measure] = [result.get(f"c{i}_{measure}") for i in range(len(profile))]
+
+    profile['null_rate'] = profile['nulls'].astype(float) / rows if rows > 0 else float("nan")
+    profile = profile.astype({'nulls': 'Int64', 'distinct': 'Int64', 'future': 'Int64', 'pre2009': 'Int64'})
+    profile['min'] = pd.to_datetime(profile['min'])
+    profile['max'] = pd.to_datetime(profile['max'])
+    return profile[['table', 'column', 'type'] + measures]
+
+
+
+def profilequeries(table_schema):
+    # the profile query for each table in OpenSAFELYSchemaInformation with a DataSource, as a dict of
+    # table: (columns, query), with the columns in table order for profileframe
+
+    schema = table_schema[table_schema['DataSource'].notna() & (table_schema['DataSource'] != "")]
+    schema = schema.assign(_position=pd.to_numeric(schema['ColumnId'], errors='coerce'))
+
+    queries = {}
+    for table, columns in schema.sort_values(['TableName', '_position'], kind='stable').groupby('TableName', sort=True):
+        columns = columns[['ColumnName', 'ColumnType']].astype(str).reset_index(drop=True)
+        queries[table] = (columns, profilequery(table, columns))
+    return queries
+
+
+
+def readprofiles(profile_dir):
+    # the saved profiles of every build, as one dataframe with a `build` column, oldest build first
+    # each build is a directory of profile_dir named by build date, with a csv per table
+
+    profiles = []
+    builds = sorted(build for build in os.listdir(profile_dir) if os.path.isdir(os.path.join(profile_dir, build))) if os.path.isdir(profile_dir) else []
+    for build in builds:
+        build_dir = os.path.join(profile_dir, build)
+        for filename in sorted(os.listdir(build_dir)):
+            if filename.endswith(".csv"):
+                profile = pd.read_csv(os.path.join(build_dir, filename), parse_dates=['min', 'max'])
+                profiles.append(profile.assign(build=pd.Timestamp(build)))
+
+    if len(profiles) == 0:
+        return pd.DataFrame(columns=['build', 'table', 'column', 'type'] + measures)
+    profiles = pd.concat(profiles, ignore_index=True)
+    return profiles[['build', 'table', 'column', 'type'] + measures]
+
+
+
+def profiledrift(profiles, tolerance=0.01):
+    # the columns whose data quality changed between the last two builds in `profiles` (from readprofiles)
+    # a column is listed if its null rate moved by more than `tolerance`, it has future or pre-2009 dates that it
+    # didn't have before, or its earliest date moved earlier or latest date moved back
+    # returns a dataframe indexed by table and column with the measures at both builds and what changed
+
+    builds = sorted(profiles['build'].unique())
+    if len(builds) < 2:
+        return pd.DataFrame(columns=drift_columns)
+
+    keys = ['table', 'column']
+    previous = profiles[profiles['build'] == builds[-2]].set_index(keys)
+    latest = profiles[profiles['build'] == builds[-1]].set_index(keys)
+    both = latest.join(previous, how='inner', lsuffix='', rsuffix='_previous')
+
+    changes = pd.DataFrame({
+        "null rate": (both['null_rate'] - both['null_rate_previous']).abs() > tolerance,
+        "new future dates": both['future'].fillna(0).gt(0) & both['future_previous'].fillna(0).eq(0),
+        "new pre-2009 dates": both['pre2009'].fillna(0).gt(0) & both['pre2009_previous'].fillna(0).eq(0),
+        "earlier first date": both['min'] < both['min_previous'],
+        "earlier last date": both['max'] < both['max_previous'],
+    }, index=both.index).astype(bool)
+
+    changed = changes.any(axis=1)
+    drift = both.assign(change=changes.dot(changes.columns + ", ").str[:-2])[drift_columns][changed]
+    return drift.sort_index()
@@ -0,0 +1,308 @@
+import os
+import html
+import json
+import hashlib
+import pandas as pd
+
+from outputs import replacing
+
+
+
+# HTML rendering of the OpenSAFELYSchemaInformation table for the database-schema notebook.
+#
+# Every table is rendered through the same template, from a single pass over the schema dataframe: the html for each
+# row is built for all columns of all tables at once, then joined into one fragment per table with one groupby.
+#
+# Each run's schema can be saved as a snapshot, so the notebook can report the tables that changed since the last
+# build. Tables are identified by a hash of their rows, and the html for tables whose hash hasn't changed is reused
+# from a cache rather than rendered again. The snapshots and the cache are read back from the notebook's own earlier
+# outputs, see lib/outputs.py.
+
+# columns of OpenSAFELYSchemaInformation that are not shown in each table's schema
+hidden_columns = ['TableName', 'DataSource', 'ColumnId', 'CollationName']
+
+table_template = """<h4 id="table-{anchor}">{table}</h4>
+<table class="schema">
+<thead><tr>{header}</tr></thead>
+<tbody>
+{rows}
+</tbody>
+</table>
+"""
+
+source_template = """<h3 id="source-{anchor}">{source}</h3>
+{tables}
+"""
+
+style = """<style>
+table.schema th, table.schema td { text-align: left; }
+</style>
+"""
+
+# a search box over the schema, answered from an inverted index embedded in the page as json, so a lookup only reads the
+# index rather than searching the rendered tables. Type a (part of a) column name, or type:<column type>, eg type:date
+search_template = """<div class="schema-search">
+<input type="search" id="schema-search" placeholder="Find a column, or type:date" autocomplete="off" style="width: 30em;">
+<ul id="schema-search-results"></ul>
+</div>
+<script type="application/json" id="schema-index">{index}</script>
+<script>
+(function() {
+  var index = JSON.parse(document.getElementById("schema-index").textContent);
+  var input = document.getElementById("schema-search");
+  var results = document.getElementById("schema-search-results");
+  var columns = Object.keys(index.columns).map(function(name) { return [name.toLowerCase(), name]; });
+
+  function add(label, id) {
+    var table = index.tables[id];
+    var item = document.createElement("li");
+    var link = document.createElement("a");
+    link.href = "#table-" + table[1];
+    link.textContent = table[0] + " / " + table[1];
+    item.appendChild(link);
+    item.appendChild(document.createTextNode(" " + label));
+    results.appendChild(item);
+  }
+
+  input.addEventListener("input", function() {
+    var query = input.value.trim().toLowerCase();
+    results.innerHTML = "";
+    if (query.indexOf("type:") === 0) {
+      var type = query.slice(5);
+      (index.types[type] || []).slice(0, {limit}).forEach(function(match) { add(match[1] + " (" + type + ")", match[0]); });
+      return;
+    }
+    if (query.length < 2) return;
+    var shown = 0;
+    for (var i = 0; i < columns.length && shown < {limit}; i++) {
+      if (columns[i][0].indexOf(query) === -1) continue;
+      index.columns[columns[i][1]].forEach(function(id) { if (shown++ < {limit}) add(columns[i][1], id); });
+    }
+  });
+})();
+</script>
+"""
+
+
+
+def normaliseschema(table_schema):
+    # the schema as strings (missing values as ""), sorted by source, table and column position, without tables that have no
+    # DataSource, so the same schema gives the same rows and hashes whether read from the database or from a snapshot
+
+    schema = table_schema[table_schema['DataSource'].notna() & (table_schema['DataSource'] != "")]
+    schema = schema.assign(_position=pd.to_numeric(schema['ColumnId'], errors='coerce'))
+    schema = schema.sort_values(['DataSource', 'TableName', '_position'], kind='stable').drop(columns='_position')
+    return schema.astype(object).where(schema.notna(), "").astype(str).reset_index(drop=True)
+
+
+
+def schemacolumns(table_schema):
+    # the columns shown for each table, with ColumnName first
+    return ['ColumnName'] + [col for col in table_schema.columns if col not in hidden_columns + ['ColumnName']]
+
+
+
+def rowshtml(schema, columns):
+    # the <tr> for every row of a normalised schema dataframe, as a series with the same index
+    rows = pd.Series("<tr>", index=schema.index, dtype=object)
+    for col in columns:
+        rows = rows + "<td>" + schema[col].map(html.escape) + "</td>"
+    return rows + "</tr>"
+
+
+
+def headerhtml(schema):
+    return "".join(f"<th>{html.escape(col)}</th>" for col in schemacolumns(schema))
+
+
+
+def tablefragments(table_schema):
+    # the html for each table, as a series indexed by (DataSource, TableName) and sorted by source then table
+    # tables without a DataSource are left out, as in the table names list
+
+    schema = normaliseschema(table_schema)
+    columns = schemacolumns(schema)
+    header = headerhtml(schema)
+
+    rows = rowshtml(schema, columns).groupby([schema['DataSource'], schema['TableName']], sort=True).agg("\n".join)
+
+    return pd.Series(
+        [
+            table_template.format(anchor=html.escape(table, quote=True), table=html.escape(table), header=header, rows=table_rows)
+            for (source, table), table_rows in rows.items()
+        ],
+        index=rows.index,
+        dtype=object,
+    )
+
+
+
+def renderschema(fragments):
+    # the html for the whole schema from the table fragments, with a heading for each source
+    sources = fragments.groupby(level='DataSource', sort=True).agg("".join)
+    return style + "".join(
+        source_template.format(anchor=html.escape(source, quote=True), source=html.escape(source), tables=tables)
+        for source, tables in sources.items()
+    )
+
+
+
+def tablehashes(schema):
+    # a hash of the rows of each table in a normalised schema, as a series indexed by (DataSource, TableName)
+    # a table's hash changes if any of its columns is added, removed, reordered or changed
+    rowhashes = pd.util.hash_pandas_object(schema, index=False)
+    return rowhashes.groupby([schema['DataSource'], schema['TableName']], sort=True).agg(
+        lambda hashes: hashlib.sha1(hashes.to_numpy().tobytes()).hexdigest()
+    )
+
+
+
+def writesnapshot(snapshot_dir, schema, run_date):
+    # save a normalised schema as the snapshot for run_date ('YYYY-MM-DD'), replacing any earlier snapshot from the same day
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = os.path.join(snapshot_dir, f"{run_date}.csv.gz")
+    with replacing(path) as tmp_path:
+        schema.to_csv(tmp_path, index=False, compression='gzip')
+
+
+
+def readsnapshot(snapshot_dir, before):
+    # the most recent snapshot saved before the date `before` ('YYYY-MM-DD'), as (date, normalised schema), or (None, None)
+    if not os.path.exists(snapshot_dir):
+        return None, None
+    dates = sorted(name[:-len(".csv.gz")] for name in os.listdir(snapshot_dir) if name.endswith(".csv.gz"))
+    dates = [d for d in dates if d < str(before)]
+    if not dates:
+        return None, None
+    schema = pd.read_csv(os.path.join(snapshot_dir, f"{dates[-1]}.csv.gz"), dtype=str, keep_default_na=False)
+    return dates[-1], normaliseschema(schema)
+
+
+
+def schemachanges(previous, schema):
+    # the tables added, removed or changed between two normalised schemas
+    # returns a dataframe with DataSource, TableName, Change ("added", "removed" or "changed"), and for changed tables
+    # the names of the columns added, removed or changed in ColumnsAdded, ColumnsRemoved and ColumnsChanged
+
+    hashes = pd.concat([tablehashes(previous).rename('previous'), tablehashes(schema).rename('current')], axis=1)
+    hashes = hashes[hashes['previous'] != hashes['current']]
+
+    keys = ['DataSource', 'TableName', 'ColumnName']
+    columns = previous.merge(schema, on=keys, how='outer', suffixes=('_previous', ''), indicator=True)
+    compared = [col for col in schema.columns if col not in keys and col + '_previous' in columns.columns]
+    modified = (columns[compared].to_numpy() != columns[[col + '_previous' for col in compared]].to_numpy()).any(axis=1)
+    columns['column_change'] = columns['_merge'].map({'left_only': 'ColumnsRemoved', 'right_only': 'ColumnsAdded', 'both': 'ColumnsChanged'})
+    columns = columns[(columns['_merge'] != 'both') | modified]
+
+    names = columns.groupby(['DataSource', 'TableName', 'column_change'], observed=True)['ColumnName'].agg(", ".join).unstack()
+    names = names.reindex(columns=['ColumnsAdded', 'ColumnsRemoved', 'ColumnsChanged'])
+
+    changes = pd.DataFrame({
+        'Change': hashes['previous'].isna().map({True: "added", False: "changed"}).where(hashes['current'].notna(), "removed")
+    }, index=hashes.index)
+    changes = changes.join(names).fillna("")
+    # the columns of tables that were added or removed altogether aren't listed
+    changes.loc[changes['Change'] != "changed", names.columns] = ""
+    changes.index.names = ['DataSource', 'TableName']
+    return changes.sort_index().reset_index()
+
+
+
+def cachedfragments(schema, hashes, cache_path):
+    # the html for each table, as from tablefragments, re-rendering only tables whose hash isn't in the cache at cache_path
+    # the cache is keyed on the table hash and the template, so changing the template re-renders every table
+    # tables no longer in the schema are dropped from the cache
+
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+
+    template = hashlib.sha1((table_template + headerhtml(schema)).encode('utf-8')).hexdigest()
+    keys = hashes.map(lambda table_hash: hashlib.sha1((table_hash + template).encode('utf-8')).hexdigest())
+
+    stale = keys[~keys.isin(list(cache))]
+    if len(stale) > 0:
+        tables = schema.set_index(['DataSource', 'TableName']).index.isin(stale.index)
+        for table, fragment in tablefragments(schema[tables]).items():
+            cache[keys[table]] = fragment
+
+    fragments = pd.Series([cache[key] for key in keys], index=keys.index, dtype=object)
+
+    os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+    with replacing(cache_path) as tmp_path, open(tmp_path, "w") as f:
+        json.dump({key: cache[key] for key in keys}, f)
+
+    return fragments
+
+
+
+def searchindex(schema):
+    # an inverted index of a normalised schema, for the search box: the (DataSource, TableName) of each table, the tables
+    # (as positions in that list) with each column name, and the (table, column name) pairs with each column type (lower case)
+
+    tables = schema[['DataSource', 'TableName']].drop_duplicates().reset_index(drop=True)
+    table_ids = pd.MultiIndex.from_frame(tables).get_indexer(pd.MultiIndex.from_frame(schema[['DataSource', 'TableName']]))
+    schema = schema.assign(_table=table_ids, _type=schema['ColumnType'].str.lower())
+
+    columns = schema.groupby('ColumnName', sort=True)['_table'].agg(lambda ids: sorted(set(ids)))
+    types = schema.groupby('_type', sort=True)[['_table', 'ColumnName']].apply(lambda rows: rows.values.tolist())
+
+    return dict(
+        tables=tables.values.tolist(),
+        columns={name: [int(id) for id in ids] for name, ids in columns.items()},
+        types={name: [[int(id), column] for id, column in pairs] for name, pairs in types.items()},
+    )
+
+
+
+def searchhtml(index, limit=200):
+    # the search box for an index from searchindex, showing at most `limit` matches
+    # the json is escaped so that a column name can never close the <script> it is embedded in
+    data = json.dumps(index, separators=(',', ':')).replace("</", "<\\/")
+    return search_template.replace("{index}", data).replace("{limit}", str(limit))
+
+
+
+# the rows and pages of every table, from the catalog views rather than by counting, so it is near-instant even for the
+# largest tables. Rows are from the heap or clustered index only, while pages include every index.
+# LastUpdate is the last insert, update or delete since the server was restarted, and LastSchemaChange the last ALTER
+# reading dm_db_partition_stats and dm_db_index_usage_stats needs VIEW DATABASE STATE permission
+# only tables in the dbo schema are listed, as those are the tables OpenSAFELYSchemaInformation describes, and a table of
+# the same name in another schema would otherwise be matched to it by name
+table_size_query = """
+    SELECT
+        t.name AS TableName,
+        SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.row_count ELSE 0 END) AS Rows,
+        SUM(ps.reserved_page_count) AS ReservedPages,
+        SUM(ps.used_page_count) AS UsedPages,
+        MAX(usage.last_update) AS LastUpdate,
+        t.modify_date AS LastSchemaChange
+    FROM sys.tables AS t
+    JOIN sys.dm_db_partition_stats AS ps ON ps.object_id = t.object_id
+    OUTER APPLY (
+        SELECT MAX(last_user_update) AS last_update
+        FROM sys.dm_db_index_usage_stats AS us
+        WHERE us.database_id = DB_ID() AND us.object_id = t.object_id
+    ) AS usage
+    WHERE SCHEMA_NAME(t.schema_id) = 'dbo'
+    GROUP BY t.object_id, t.name, t.modify_date
+"""
+
+# SQL Server pages are 8KB
+page_mb = 8 / 1024
+
+
+
+def tablesizes(sizes, schema):
+    # the rows, reserved and used space (in MB) and last update of each table in a normalised schema, from the result of
+    # table_size_query, sorted by source and table. Tables in the schema that the catalog views don't list have no size
+
+    tables = schema[['DataSource', 'TableName']].drop_duplicates()
+    sizes = sizes.assign(
+        ReservedMB=(sizes['ReservedPages'] * page_mb).round(1),
+        UsedMB=(sizes['UsedPages'] * page_mb).round(1),
+    )
+    sizes = sizes[['TableName', 'Rows', 'ReservedPages', 'UsedPages', 'ReservedMB', 'UsedMB', 'LastUpdate', 'LastSchemaChange']]
+    sizes = tables.merge(sizes, on='TableName', how='left').astype({'Rows': 'Int64', 'ReservedPages': 'Int64', 'UsedPages': 'Int64'})
+    return sizes.sort_values(['DataSource', 'TableName']).reset_index(drop=True)
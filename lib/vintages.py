@@ -0,0 +1,136 @@
+import os
+import numpy as np
+import pandas as pd
+
+from outputs import replacing
+
+
+
+# Build vintages of each source's daily counts, to measure how much recent counts are revised by later imports.
+#
+# Each import overwrites the data, so the daily counts extracted after each import are kept as a vintage, keyed by
+# the source's BuildDate. Most of a series doesn't change between imports, so each vintage is saved as its differences
+# from the previous one: only the days whose counts changed, and by how much. The first vintage is saved in full, as
+# its differences from nothing. Any vintage is the running total of the differences up to it, so all the vintages of a
+# source are rebuilt at once as a (date x build) matrix with one cumulative sum.
+#
+# The vintages are read back from the outputs of earlier runs, see lib/outputs.py.
+#
+# files: vintage_dir/source name/YYYY-MM-DD.csv.gz, with date and delta columns
+
+# the share of a day's final count it must reach for the day to count as complete
+complete_share = 0.95
+
+
+
+def readvintages(vintage_dir, name, before=None):
+    # the daily counts of every saved vintage of a source, as a (date x build date) dataframe
+    # set before (a 'YYYY-MM-DD' string) for only the vintages before that build date
+    # returns an empty dataframe if there are none
+
+    source_dir = os.path.join(vintage_dir, name)
+    builds = sorted(filename[:-len(".csv.gz")] for filename in os.listdir(source_dir) if filename.endswith(".csv.gz")) if os.path.isdir(source_dir) else []
+    if before is not None:
+        builds = [build for build in builds if build < before]
+    if len(builds) == 0:
+        return pd.DataFrame(index=pd.DatetimeIndex([], name='date'))
+
+    deltas = pd.concat([
+        pd.read_csv(os.path.join(source_dir, f"{build}.csv.gz"), parse_dates=['date']).assign(build=pd.Timestamp(build))
+        for build in builds
+    ], ignore_index=True)
+    matrix = deltas.pivot_table(index='date', columns='build', values='delta', aggfunc='sum', fill_value=0)
+    matrix = matrix.reindex(columns=pd.to_datetime(builds), fill_value=0)
+    matrix.columns.name = None
+    return matrix.cumsum(axis=1)
+
+
+
+def writevintage(vintage_dir, name, df, build_date):
+    # save a (date, count) dataframe of daily counts as the vintage of a source for build_date ('YYYY-MM-DD'),
+    # as its differences from the latest earlier vintage. A vintage that is already saved is left as it is
+
+    source_dir = os.path.join(vintage_dir, name)
+    path = os.path.join(source_dir, f"{build_date}.csv.gz")
+    if os.path.exists(path):
+        return
+    os.makedirs(source_dir, exist_ok=True)
+
+    previous = readvintages(vintage_dir, name, before=build_date)
+    previous = previous.iloc[:, -1] if previous.shape[1] > 0 else pd.Series(dtype=np.int64)
+    current = df.groupby(pd.to_datetime(df['date']))['count'].sum()
+    delta = current.sub(previous, fill_value=0).astype(np.int64)
+    delta = delta[delta != 0]
+
+    with replacing(path) as tmp_path:
+        delta.rename_axis('date').rename('delta').reset_index().to_csv(tmp_path, index=False, compression="gzip")
+
+
+
+def revisions(vintages, max_lag=60):
+    # how complete each day's count is at each lag (days from the day to the build that counted it), compared with
+    # the latest vintage, from a (date x build) dataframe from readvintages. Computed for every (day, build) at once
+    # returns a dataframe indexed by lag (0 to max_lag) with
+    #   median and lower_quartile: the median and lower quartile of each day's count as a share of its latest count
+    #   revised: the share of days whose count at that lag is different in the latest vintage
+    #   days: the number of (day, build) pairs at that lag
+    # days with no events in the latest vintage, and the latest vintage itself, are left out
+
+    columns = ['median', 'lower_quartile', 'revised', 'days']
+    if vintages.shape[1] < 2:
+        return pd.DataFrame(columns=columns, index=pd.RangeIndex(0, 0, name='lag'))
+
+    values = vintages.to_numpy(dtype=float)[:, :-1]
+    final = vintages.to_numpy(dtype=float)[:, -1:]
+    lags = (vintages.columns[:-1].to_numpy()[None, :] - vintages.index.to_numpy()[:, None]) // np.timedelta64(1, 'D')
+
+    keep = (lags >= 0) & (lags <= max_lag) & (final > 0)
+    long = pd.DataFrame({
+        'lag': lags[keep],
+        'share': (values / np.where(final > 0, final, 1))[keep],
+        'revised': (values != final)[keep],
+    })
+    grouped = long.groupby('lag')
+    report = pd.DataFrame({
+        'median': grouped['share'].median(),
+        'lower_quartile': grouped['share'].quantile(0.25),
+        'revised': grouped['revised'].mean(),
+        'days': grouped['share'].size(),
+    })
+    return report.reindex(pd.RangeIndex(0, max_lag + 1, name='lag'))
+
+
+
+def completelag(revision, share=complete_share):
+    # the smallest lag from which the median day is at least `share` complete at every later lag, from revisions,
+    # ie how many days before its latest build a source's counts should be treated as incomplete, and how far back
+    # an incremental refresh needs to re-query. NaN if there are no revisions to measure
+
+    measured = revision['median'].dropna()
+    if len(measured) == 0:
+        return np.nan
+    incomplete = measured.index[measured < share]
+    return 0 if len(incomplete) == 0 else int(incomplete.max()) + 1
+
+
+
+def revisionreport(vintage_dir, names, max_lag=60, share=complete_share):
+    # a row for each source in `names` with saved vintages, indexed by source, with
+    #   vintages: the number of vintages saved, and latest_build: the latest one
+    #   complete_lag: from completelag
+    #   median_lag_0, median_lag_7, ...: the median share of the latest count at each of those lags
+
+    rows = {}
+    for name in names:
+        vintages = readvintages(vintage_dir, name)
+        if vintages.shape[1] == 0:
+            continue
+        revision = revisions(vintages, max_lag=max_lag)
+        row = dict(vintages=vintages.shape[1], latest_build=vintages.columns[-1], complete_lag=completelag(revision, share=share))
+        row.update({f"median_lag_{lag}": revision['median'].get(lag, np.nan) for lag in [0, 7, 14, 28]})
+        rows[name] = row
+
+    columns = ['vintages', 'latest_build', 'complete_lag', 'median_lag_0', 'median_lag_7', 'median_lag_14', 'median_lag_28']
+    report = pd.DataFrame.from_dict(rows, orient='index', columns=columns) if rows else pd.DataFrame(columns=columns)
+    report.index.name = 'source'
+    return report
@@ -82,6 +82,10 @@ from IPython.display import display, Markdown
 import sys
 sys.path.append('../lib/')
 from functions import *
+from extraction import *
+from disclosure import redact
+from planner import readplan, plantitles
+from vintages import revisionreport
 
 
 # +
@@ -168,116 +172,38 @@ date_range = pd.DataFrame(
 
 
 # +
-def datequery(table, var_table, from_date, to_date):
-    query = (
-      f"""
-        SELECT {var_table} AS date, COUNT(*) AS count
-        FROM {table}
-        WHERE {var_table} >= CONVERT(date, '{from_date}') AND {var_table} <= CONVERT(date, '{to_date}')
-        GROUP BY {var_table}
-        ORDER BY {var_table}
-      """
-    )
-    return query
-
-start_date_text = start_date.strftime('%Y-%m-%d')
-end_date_text = end_date.strftime('%Y-%m-%d')
-
-#CodedEvent_query = datequery("CodedEvent", "ConsultationDate", "consultation_date", start_date_text, end_date_text)
-#Appointment_query = datequery("Appointment", "SeenDate", "appointment_date", start_date_text, end_date_text)
-APCS_query = datequery("APCS", "Admission_Date", start_date_text, end_date_text)
-CPNS_query = datequery("CPNS", "DateOfDeath", start_date_text, end_date_text)
-EC_query = datequery("EC", "Arrival_Date", start_date_text, end_date_text)
-ICNARC_query = datequery("ICNARC", "CONVERT(date, IcuAdmissionDateTime)", start_date_text, end_date_text)
-ONS_query = datequery("ONS_Deaths", "dod", start_date_text, end_date_text)
-OPA_query = datequery("OPA", "Appointment_Date", start_date_text, end_date_text)
-SGSS_query = datequery("""( 
-         SELECT Earliest_Specimen_Date FROM SGSS_Positive 
-         UNION ALL
-         SELECT Earliest_Specimen_Date FROM SGSS_Negative
-         )  AS a""", 
-        "Earliest_Specimen_Date", start_date_text, end_date_text)
-SGSSpos_query = datequery("SGSS_Positive", "Earliest_Specimen_Date", start_date_text, end_date_text)
-SGSS_AllTests_query = datequery("""( 
-         SELECT Specimen_Date FROM SGSS_AllTests_Positive 
-         UNION ALL
-         SELECT Specimen_Date FROM SGSS_AllTests_Negative
-         )  AS a""", 
-        "Specimen_Date", start_date_text, end_date_text)
-SGSSpos_AllTests_query = datequery("SGSS_AllTests_Positive", "Specimen_Date", start_date_text, end_date_text)
-Therapeutics_query = datequery("Therapeutics", "TreatmentStartDate", start_date_text, end_date_text)
+# The daily counts for each source are extracted once per import by analysis/extract_daily_counts.py, into a store
+# shared with the database-history notebook, and sliced to the period shown here.
+counts, extraction_summary = readcounts("../output/daily_counts", from_date=start_date, to_date=end_date)
 
-with closing_connection(dbconn) as cnxn:
-    #CodedEvent_df = pd.read_sql(CodedEvent_query, cnxn, parse_dates=['coded_event_date'])
-    #Appointment_df = pd.read_sql(Appointment_query, cnxn, parse_dates=['appointment_date'])
-    APCS_df = pd.read_sql(APCS_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    OPA_df = pd.read_sql(OPA_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    CPNS_df = pd.read_sql(CPNS_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    EC_df = pd.read_sql(EC_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    ICNARC_df = pd.read_sql(ICNARC_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    ONS_df = pd.read_sql(ONS_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    SGSS_df = pd.read_sql(SGSS_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    SGSSpos_df = pd.read_sql(SGSSpos_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    SGSS_all_df = pd.read_sql(SGSS_AllTests_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    SGSSpos_all_df = pd.read_sql(SGSSpos_AllTests_query, cnxn, parse_dates=['date'])
-with closing_connection(dbconn) as cnxn:
-    Therapeutics_df = pd.read_sql(Therapeutics_query, cnxn, parse_dates=['date'])
-    
-# Note that CodedEvent and Appointment extracts take a long time to run.
+# how long each source's recent counts take to be complete, measured from the counts of earlier imports
+revision_report = revisionreport("../output/daily_counts/vintages", list(counts))
+
+failed = extraction_summary[extraction_summary['status'].isin(["failed", "skipped"])]
+if len(failed) > 0:
+    display(Markdown("The following sources could not be extracted on this run, so are not shown below:"))
+    display(failed[['source', 'error']].set_index('source'))
 
 # +
-def eventcountseries(df, date_range, rule='D', popadjust=False):
-    # to calculate the daily count for events recorded in a series
-    # where event_dates is a series
-    # set popadjust = 1000, say, to report counts per 1000 population
-    
-    df = df.set_index('date')
-    counts = df['count'].reindex(date_range.index, fill_value=0)
-            
-    if rule != "D":
-        counts = counts.resample(rule).sum()
-    
-    if popadjust is not False:
-        pop = counts.sum()
-        poppern= pop/popadjust
-        counts = counts.transform(lambda x: x/poppern)
-    
-    return(counts)
+# daily and weekly counts for every source as (date x source) matrices, with small numbers redacted for all sources at once
+counts_day, redact_day = redact(countmatrix(counts, date_range, rule="D"))
+counts_week, _ = redact(countmatrix(counts, date_range, rule="W-FRI"))
 
-def createcounts(date_range, df, lastdate, lookback):
-    counts_day = eventcountseries(df, date_range, rule="D")
-    counts_week = eventcountseries(df, date_range, rule="W-FRI")
-       
+
+def createcounts(name, lastdate, lookback):
+    # the redacted counts for one source, and for its last `lookback` days up to lastdate
     lastdaterecent = lastdate - pd.to_timedelta(lookback, unit="D")
-    lastcounts = counts_day.loc[(counts_day.index >= lastdaterecent) & (counts_day.index <= lastdate)]
-    lastredact = (lastcounts <6) & (lastcounts>0)
-    lastcounts = lastcounts.where(~lastredact, 3) #redact small numbers
-        
-    redact_day = (counts_day <6) & (counts_day>0)
-    counts_day = counts_day.where(~redact_day, 3)
-        
-    redact_week = (counts_week <6) & (counts_week>0)
-    counts_week = counts_week.where(~redact_week, 3)
+    recent = (counts_day.index >= lastdaterecent) & (counts_day.index <= lastdate)
     
-    return counts_day, counts_week, lastcounts, lastredact
+    return counts_day[name], counts_week[name], counts_day.loc[recent, name], redact_day.loc[recent, name]
 
 
-def plotcounts(date_range, df, title=""):
+def plotcounts(date_range, name, title=""):
     # This function plots event counts over time both overall and for the last X days up to the most recent extracted event.
     
-    date = df['date']
     startdate = date_range.index.min()
     enddate = date_range.index.max()
-    lastdate = df['date'].max()
+    lastdate = counts[name]['date'].max()
         
     startdatestring = startdate.strftime('%-d %B %Y')
     enddatestring = enddate.strftime('%-d %B %Y')
@@ -285,15 +211,21 @@ def plotcounts(date_range, df, title=""):
     
     lookback=30
 
-    counts_day, counts_week, lastcounts, redact = createcounts(date_range, df, lastdate, lookback)
+    counts_day, counts_week, lastcounts, redacted = createcounts(name, lastdate, lookback)
     
    # xlimlower = mdates.date2num(lastcounts.index[0]+pd.DateOffset(days=-1))
    # xlimupper = mdates.date2num(lastcounts.index[-1]+pd.DateOffset(days=+1))
     
     fig, axs = plt.subplots(1, 2, figsize=(15,5))
     
+    # days since the source's cutoff are usually revised up by later imports, see "Revisions to recent counts" below
+    if name in revision_report.index and pd.notna(revision_report.loc[name, 'complete_lag']):
+        cutoff = revision_report.loc[name, 'latest_build'] - pd.to_timedelta(revision_report.loc[name, 'complete_lag'], unit="D")
+        if cutoff <= lastdate:
+            axs[1].axvspan(cutoff - pd.Timedelta(12, unit='h'), lastdate + pd.Timedelta(12, unit='h'), color='lightgrey', zorder=0)
+    
     axs[1].plot(lastcounts.index, lastcounts, marker='o', markersize=5, color='darkblue', zorder=1)
-    axs[1].plot(lastcounts[redact].index, lastcounts[redact], 'o', linestyle = 'None', color='None', zorder=2)
+    axs[1].plot(lastcounts[redacted].index, lastcounts[redacted], 'o', linestyle = 'None', color='None', zorder=2)
     axs[1].xaxis.set_tick_params(labelrotation=70)
     axs[1].xaxis.set_major_locator(ticker.MultipleLocator(2))
     axs[1].set_ylim(bottom=0)
@@ -309,6 +241,14 @@ def plotcounts(date_range, df, title=""):
     
     axs[0].plot(counts_day.index, counts_day, color='darkblue', zorder=2)
     axs[0].plot(counts_week.index - pd.DateOffset(3), counts_week/7, color='lightblue', zorder=3)
+    
+    # sources counted from a sample are shown with the confidence interval of each day's estimate
+    interval = sampleinterval(counts[name], date_range)
+    if interval is not None:
+        lower, upper = interval
+        axs[0].fill_between(lower.index, lower, upper, color='lightsteelblue', linewidth=0, zorder=1.5)
+        recentlower, recentupper = lower.loc[lastcounts.index], upper.loc[lastcounts.index]
+        axs[1].fill_between(recentlower.index, recentlower, recentupper, color='lightsteelblue', linewidth=0, zorder=0.5)
     axs[0].set_ylabel('Event counts')
     axs[0].xaxis.set_tick_params(labelrotation=70)
     axs[0].set_ylim(bottom=0)
@@ -329,21 +269,84 @@ def plotcounts(date_range, df, title=""):
         """
         Counts are based on raw event data and should not be used for clinical or epidemiological inference.
         Counts of five or less are set to 3 and masked for disclosure control.
-        """,
+        """ + ("""Counts are estimated from a sample of events, shaded with their 95% confidence intervals.
+        """ if interval is not None else ""),
         ha='left'
     )
     plt.show()
 
 
-#plotcounts(date_range, CodedEvent_df['coded_event_date'], title="Any coded event in Primary Care, from SystmOne")
-plotcounts(date_range, SGSS_df, title="First-only SARS-CoV2 test (SGSS)")
-plotcounts(date_range, SGSSpos_df, title="First-only Positive SARS-CoV2 test (SGSS)")
-plotcounts(date_range, SGSS_all_df, title="Any SARS-CoV2 test (SGSS)")
-plotcounts(date_range, SGSSpos_all_df, title="Positive SARS-CoV2 test (SGSS)")
-plotcounts(date_range, EC_df, title="A&E attendance (SUS EC)")
-plotcounts(date_range, APCS_df, title="In-patient hospital admission (SUS APCS)")
-plotcounts(date_range, OPA_df, title="Out-patient hospital appointment (SUS OPA)")
-plotcounts(date_range, ICNARC_df, title="Covid-related ICU admission (ICNARC)")
-plotcounts(date_range, CPNS_df, title="Covid-related in-hospital death (CPNS)")
-plotcounts(date_range, ONS_df, title="Registered death (ONS)")
-plotcounts(date_range, Therapeutics_df, title="COVID-19 therapeutics (NHSE)")
+titles = {
+    "CodedEvent": "Any coded event in primary care (SystmOne)",
+    "Appointment": "Appointment seen in primary care (SystmOne)",
+    "SGSS": "First-only SARS-CoV2 test (SGSS)",
+    "SGSSpos": "First-only Positive SARS-CoV2 test (SGSS)",
+    "SGSS_all": "Any SARS-CoV2 test (SGSS)",
+    "SGSSpos_all": "Positive SARS-CoV2 test (SGSS)",
+    "EC": "A&E attendance (SUS EC)",
+    "APCS": "In-patient hospital admission (SUS APCS)",
+    "OPA": "Out-patient hospital appointment (SUS OPA)",
+    "ICNARC": "Covid-related ICU admission (ICNARC)",
+    "CPNS": "Covid-related in-hospital death (CPNS)",
+    "ONS": "Registered death (ONS)",
+    "Therapeutics": "COVID-19 therapeutics (NHSE)",
+}
+
+for name, title in titles.items():
+    if name not in counts:
+        display(Markdown(f"**{title}**: not available, the extraction failed or was skipped on this run."))
+    elif len(counts[name]) == 0:
+        display(Markdown(f"**{title}**: no events were counted."))
+    else:
+        plotcounts(date_range, name, title=title)
+
+# ## Event activity in other tables
+#
+# The figures below show event activity for the other tables in the OpenSAFELY-TPP database that have an event date. These tables and their date columns are found from the database schema, so the choice of date column has not been checked by hand. Each plot is titled with the table name and the date column counted.
+#
+# Counts of five or less are redacted.
+
+# +
+plan = readplan("../output/daily_counts")
+
+for name, title in plantitles(plan, counts, titles).items():
+    if len(counts[name]) > 0:
+        plotcounts(date_range, name, title=title)
+# -
+
+# ## Revisions to recent counts
+# Each import of a dataset replaces the previous one, and events are often added for recent days in later imports, so the counts for the latest days in each source are usually incomplete. The daily counts from each import are kept, and the table below compares the count for each day, as it was in each import, with the count for the same day in the latest import:
+#
+# * `vintages`, the number of imports compared, and `latest_build`, the date of the latest.
+# * `median_lag_0`, `median_lag_7`, ..., the median share of each day's latest count that was present in an import the same day, or 7, 14 or 28 days later.
+# * `complete_lag`, the number of days after which the median day is at least 95% complete. Days more recent than this before the latest import are shaded grey in the plots of the last 30 days above.
+#
+# Sources with only one import so far are not listed.
+
+if len(revision_report) == 0:
+    display(Markdown("No sources have more than one import to compare yet."))
+else:
+    display(revision_report[revision_report['vintages'] > 1].round(3))
+
+# ## Event activity in external datasets by region
+#
+# The figures below show daily event counts for selected external data sources, by the region of the GP practice each patient was registered with on the date of the event. Events for patients with no registration on that date are shown as "Unknown". 
+#
+# Counts of five or less are set to 3, and other counts are rounded to the nearest 5, for disclosure control. The national counts above are not rounded, so the regions' counts are, to stop a redacted count being worked out from the national count and the other regions' counts.
+
+# +
+regional_titles = {
+    "APCS_by_region": "In-patient hospital admission (SUS APCS)",
+    "EC_by_region": "A&E attendance (SUS EC)",
+    "SGSS_by_region": "First-only SARS-CoV2 test (SGSS)",
+}
+
+for name, title in regional_titles.items():
+    if name not in counts:
+        display(Markdown(f"**{title}**: not available, the extraction failed or was skipped on this run."))
+    elif len(counts[name]) == 0:
+        display(Markdown(f"**{title}**: no events were counted."))
+    else:
+        display(Markdown(f"**{title}**"))
+        regional = counts[name].assign(count=redact(counts[name]['count'], rounding=5)[0]) #redact small numbers, and round the rest
+        eventcounts_strata_plot(regional, date_range, ['count'], None, panelheight=3, gridcols=3)
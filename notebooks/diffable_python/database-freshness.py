@@ -0,0 +1,110 @@
+# ---
+# jupyter:
+#   jupytext:
+#     cell_metadata_filter: all
+#     notebook_metadata_filter: all,-language_info
+#     text_representation:
+#       extension: .py
+#       format_name: light
+#       format_version: '1.5'
+#       jupytext_version: 1.3.3
+#   kernelspec:
+#     display_name: Python 3
+#     language: python
+#     name: python3
+# ---
+
+# + [markdown]
+# # Data coverage status for OpenSAFELY-TPP data sources
+#
+# This [OpenSAFELY](https://www.opensafely.org/) notebook gives a quick summary of how up to date each data source in the [OpenSAFELY-TPP database](https://docs.opensafely.org/dataset-systmone/) is: when each dataset was last imported, the latest event date in each source, and the latest date for which its data look complete. It reads only the most recent events in each source, so runs in a few minutes and can be run much more often than the [database-builds notebook](https://github.com/opensafely/database-notebooks/blob/master/notebooks/database-builds.ipynb), which shows the full history of event activity for each source. It is part of the technical documentation for users of the OpenSAFELY platform to guide analyses and **it should not be used for inference about any aspect of the pandemic, public health, or health service activity**.
+#
+# If you want to see the Python code used to create this notebook, you can [view it on GitHub](https://github.com/opensafely/database-notebooks/blob/master/notebooks/database-freshness.ipynb).
+#
+# -
+
+# +
+## Import libraries
+
+# %load_ext autoreload
+# %autoreload 2
+
+import pyodbc
+import os
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from IPython.display import display, Markdown
+
+import sys
+sys.path.append('../lib/')
+from functions import *
+from extraction import readquery
+from planner import extractionplan
+from freshness import *
+
+
+# +
+# get server credentials from environment variable
+
+dbconn = os.environ.get('FULL_DATABASE_URL', None).strip('"')
+
+# +
+with closing_connection(dbconn) as cnxn:
+    latestbuilds = pd.read_sql(
+    """
+        select BuildDesc as datasource, max(BuildDate) as latest_import from BuildInfo
+        group by BuildDesc
+    """, cnxn)
+    table_schema = pd.read_sql("""select * from OpenSAFELYSchemaInformation""", cnxn)
+
+run_date = date.today()
+
+# the tables and event date columns are the same as those extracted for the database-builds notebook
+plan = extractionplan(table_schema)
+plan = plan[plan['included']].set_index('name')
+# -
+
+# ### Notebook run date
+
+display(Markdown(f"""This notebook was run on {run_date.strftime('%-d %B %Y')}.  The information below reflects the state of the OpenSAFELY-TPP database as at this date."""))
+
+# ## Latest dataset import dates
+# The dates in the table below are when each dataset was last imported into the OpenSAFELY-TPP database. They do not reflect when the data were received by TPP nor when the latest events captured in each dataset occurred.
+
+latestbuilds
+
+# ## Latest event dates
+# The table below gives, for each source:
+#
+# * `latest`, the latest event date that is not in the future.
+# * `complete`, the latest date with at least half the median daily number of events over the 30 days up to the latest event date. Events on later dates may still be arriving, so counts after this date are likely to be incomplete.
+# * `days_behind`, the number of days from `complete` to the date this notebook was run.
+# * `median`, the median daily number of events over the 30 days up to the latest event date, with counts of five or less set to 3.
+#
+# The table and date column used for each source are given in brackets.
+
+# +
+# each source is read with one short query, four at a time
+def recentcounts(name):
+    row = plan.loc[name]
+    try:
+        return name, readquery(dbconn, freshnessquery(row['table'], row['column'], row['var']), timeout=10*60), None
+    except Exception as e:
+        return name, None, f"{type(e).__name__}: {e}"
+
+with ThreadPoolExecutor(max_workers=4) as executor:
+    results = list(executor.map(recentcounts, plan.index))
+
+recent = {name: df for name, df, error in results if error is None}
+failed = pd.DataFrame([(name, error) for name, df, error in results if error is not None], columns=['source', 'error'])
+
+status = freshnesstable(recent, run_date)
+status.index = [f"{name} ({plan.loc[name, 'table']}.{plan.loc[name, 'column']})" for name in status.index]
+status.index.name = 'source'
+display(status.sort_values('days_behind'))
+
+if len(failed) > 0:
+    display(Markdown("The following sources could not be read on this run:"))
+    display(failed.set_index('source'))
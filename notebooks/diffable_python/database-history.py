@@ -64,6 +64,9 @@ from IPython.display import display, Markdown
 import sys
 sys.path.append('../lib/')
 from functions import *
+from extraction import *
+from disclosure import redact
+from planner import readplan, plantitles
 
 
 # +
@@ -104,105 +107,54 @@ display(Markdown(f"""This notebook was run on {run_date.strftime('%-d %B %Y')}.
 # Counts of five or less are redacted. 
 
 # +
-def datequery(table, var, from_date):
-    query = (
-      f"""
-        SELECT {var} AS date, COUNT(*) AS count
-        FROM {table}
-        WHERE {var} >= CONVERT(date, '{from_date}')
-        GROUP BY {var}
-        ORDER BY {var}
-      """
-    )
-    return query
-
-start_date_text = start_date.strftime('%Y-%m-%d')
-#CodedEvent_query = datequery("CodedEvent", "ConsultationDate", start_date_text)
-#Appointment_query = datequery("Appointment", "SeenDate", start_date_text)
-APCS_query = datequery("APCS", "Admission_Date", start_date_text)
-CPNS_query = datequery("CPNS", "DateOfDeath", start_date_text)
-EC_query = datequery("EC", "Arrival_Date", start_date_text)
-OPA_query = datequery("OPA", "Appointment_Date", start_date_text)
-ICNARC_query = datequery("ICNARC", "CONVERT(date, IcuAdmissionDateTime)", start_date_text)
-ONS_query = datequery("ONS_Deaths", "dod", start_date_text)
-SGSS_query = datequery("""( 
-         SELECT Earliest_Specimen_Date FROM SGSS_Positive 
-         UNION ALL
-         SELECT Earliest_Specimen_Date FROM SGSS_Negative
-         ) AS a """, 
-        "Earliest_Specimen_Date", start_date_text)
-SGSSpos_query = datequery("SGSS_Positive", "Earliest_Specimen_Date", start_date_text)
-SGSS_AllTests_query = datequery("""( 
-         SELECT Specimen_Date FROM SGSS_AllTests_Positive 
-         UNION ALL
-         SELECT Specimen_Date FROM SGSS_AllTests_Negative
-         ) AS a """, 
-        "Specimen_Date", start_date_text)
-SGSSpos_AllTests_query = datequery("SGSS_AllTests_Positive", "Specimen_Date", start_date_text)
+# The daily counts for each source are extracted once per import by analysis/extract_daily_counts.py, into a store
+# shared with the database-builds notebook, and sliced to the period shown here.
+counts, extraction_summary = readcounts("../output/daily_counts", from_date=start_date, to_date=None)
+
+failed = extraction_summary[extraction_summary['status'].isin(["failed", "skipped"])]
+if len(failed) > 0:
+    display(Markdown("The following sources could not be extracted on this run, so are not shown below:"))
+    display(failed[['source', 'error']].set_index('source'))
+# -
 
-with closing_connection(dbconn) as cnxn:
-    #CodedEvent_df = pd.read_sql(CodedEvent_query, cnxn, parse_dates=['coded_event_date'])
-    #Appointment_df = pd.read_sql(Appointment_query, cnxn, parse_dates=['appointment_date'])
-    APCS_df = pd.read_sql(APCS_query, cnxn, parse_dates=['date'])
-    CPNS_df = pd.read_sql(CPNS_query, cnxn, parse_dates=['date'])
-    EC_df = pd.read_sql(EC_query, cnxn, parse_dates=['date'])
-    OPA_df = pd.read_sql(OPA_query, cnxn, parse_dates=['date'])
-    ICNARC_df = pd.read_sql(ICNARC_query, cnxn, parse_dates=['date'])
-    ONS_df = pd.read_sql(ONS_query, cnxn, parse_dates=['date'])
-    SGSS_df = pd.read_sql(SGSS_query, cnxn, parse_dates=['date'])
-    SGSSpos_df = pd.read_sql(SGSSpos_query, cnxn, parse_dates=['date'])
-    SGSS_all_df = pd.read_sql(SGSS_AllTests_query, cnxn, parse_dates=['date'])
-    SGSSpos_all_df = pd.read_sql(SGSSpos_AllTests_query, cnxn, parse_dates=['date'])
-    
-# Note that CodedEvent and Appointment extracts take a long time to run.
-# The sql for the combined SGSS tables has stopped working, so are not currently run
+# +
+# daily and weekly counts for every source as (date x source) matrices, with small numbers redacted for all sources at once
+# up to the latest date of any source, or only the start date if no source has any counts
+# the weeks are totalled from the daily counts, which gives the same Monday to Sunday weeks as counting them on the server
+all_dates = pd.DataFrame(
+    index = pd.date_range(start=start_date, end=max((df['date'].max() for df in counts.values() if len(df) > 0), default=pd.Timestamp(start_date)), freq="D")
+)
+matrix_day = countmatrix(counts, all_dates, rule="D")
+matrix_week = countmatrix(counts, all_dates, rule="W")
+
+counts_day, _ = redact(matrix_day)
+counts_week, _ = redact(matrix_week)
 # -
 
-def plotcounts_history(df, title=""):
+def plotcounts_history(name, title=""):
     # This function plots event counts over time both overall and for the last X days up to the most recent extracted event.  
     
     
     
-    startdate = df['date'].min()
-    enddate = df['date'].max()
-    
-    date_range = pd.DataFrame(
-        index = pd.date_range(start=startdate, end=enddate, freq="D")
-    )
+    startdate = counts[name]['date'].min()
+    enddate = counts[name]['date'].max()
     
     startdatestring = startdate.strftime('%Y-%m-%d')
     enddatestring = enddate.strftime('%Y-%m-%d')
     
-    def eventcountseries(df, date_range, rule='D', popadjust=False):
-        # to calculate the daily count for events recorded in a series
-        # where event_dates is a series
-        # set popadjust = 1000, say, to report counts per 1000 population
-
-        df = df.set_index('date')
-        counts = df['count'].reindex(date_range.index, fill_value=0)
-
-        if rule != "D":
-            counts = counts.resample(rule).sum()
-
-        if popadjust is not False:
-            pop = counts.sum()
-            poppern= pop/popadjust
-            counts = counts.transform(lambda x: x/poppern)
-
-        return(counts)
-
-    counts_day = eventcountseries(df, date_range, rule="D")
-    redact_day = (counts_day <6) & (counts_day>0)
-    counts_day = counts_day.where(~redact_day, 3) #redact small numbers
-    
-    counts_week = eventcountseries(df, date_range, rule="W")
-    redact_week = (counts_week <6) & (counts_week>0)
-    counts_week = counts_week.where(~redact_week, 3) #redact small numbers
+    source_day = counts_day.loc[startdate:enddate, name]
+    source_week = counts_week.loc[startdate:enddate + pd.DateOffset(6), name]
        
     fig, axs = plt.subplots(1, 1, figsize=(15,5))
     
-    axs.plot(counts_day.index, counts_day, color='darkblue', zorder=2)
-    axs.plot(counts_week.index - pd.DateOffset(3), counts_week/7, color='lightblue', zorder=3)
+    axs.plot(source_day.index, source_day, color='darkblue', zorder=2)
+    axs.plot(source_week.index - pd.DateOffset(3), source_week/7, color='lightblue', zorder=3)
+    
+    # sources counted from a sample are shown with the confidence interval of each day's estimate
+    interval = sampleinterval(counts[name], all_dates)
+    if interval is not None:
+        lower, upper = interval
+        axs.fill_between(lower.loc[startdate:enddate].index, lower.loc[startdate:enddate], upper.loc[startdate:enddate], color='lightsteelblue', linewidth=0, zorder=1)
     axs.set_ylabel('event counts')
     axs.xaxis.set_tick_params(labelrotation=70)
     axs.set_ylim(bottom=0)
@@ -222,19 +174,45 @@ def plotcounts_history(df, title=""):
         """
         Counts are based on raw event data and should not be used for clinical or epidemiological inference.
         Counts of five or less are set to 3 and masked for disclosure control.
-        """,
+        """ + ("""Counts are estimated from a sample of events, shaded with their 95% confidence intervals.
+        """ if interval is not None else ""),
         ha='left'
     )
     plt.show()
 
-#plotcounts_history(CodedEvent_df['coded_event_date'], title="Any coded event in Primary Care, from SystmOne")
-plotcounts_history(SGSS_df, title="First-only SARS-CoV2 test (SGSS)")
-plotcounts_history(SGSSpos_df, title="First-only Positive SARS-CoV2 test (SGSS)")
-plotcounts_history(SGSS_all_df, title="Any SARS-CoV2 test (SGSS)")
-plotcounts_history(SGSSpos_all_df, title="Positive SARS-CoV2 test (SGSS)")
-plotcounts_history(EC_df, title="A&E attendance (SUS EC)")
-plotcounts_history(OPA_df, title="Out-patient hospital appointment (SUS OPA)")
-plotcounts_history(APCS_df, title="In-patient hospital admission (SUS APCS)")
-plotcounts_history(ICNARC_df, title="Covid-related ICU admission (ICNARC)")
-plotcounts_history(CPNS_df, title="Covid-related in-hospital death (CPNS)")
-plotcounts_history(ONS_df, title="Registered death (ONS)")
+titles = {
+    "CodedEvent": "Any coded event in primary care (SystmOne)",
+    "Appointment": "Appointment seen in primary care (SystmOne)",
+    "SGSS": "First-only SARS-CoV2 test (SGSS)",
+    "SGSSpos": "First-only Positive SARS-CoV2 test (SGSS)",
+    "SGSS_all": "Any SARS-CoV2 test (SGSS)",
+    "SGSSpos_all": "Positive SARS-CoV2 test (SGSS)",
+    "EC": "A&E attendance (SUS EC)",
+    "OPA": "Out-patient hospital appointment (SUS OPA)",
+    "APCS": "In-patient hospital admission (SUS APCS)",
+    "ICNARC": "Covid-related ICU admission (ICNARC)",
+    "CPNS": "Covid-related in-hospital death (CPNS)",
+    "ONS": "Registered death (ONS)",
+}
+
+for name, title in titles.items():
+    if name not in counts:
+        display(Markdown(f"**{title}**: not available, the extraction failed or was skipped on this run."))
+    elif len(counts[name]) == 0:
+        display(Markdown(f"**{title}**: no events were counted."))
+    else:
+        plotcounts_history(name, title=title)
+
+# ## Event activity in other tables
+#
+# The figures below show event activity for the other tables in the OpenSAFELY-TPP database that have an event date. These tables and their date columns are found from the database schema, so the choice of date column has not been checked by hand. Each plot is titled with the table name and the date column counted.
+#
+# Counts of five or less are redacted.
+
+# +
+plan = readplan("../output/daily_counts")
+
+for name, title in plantitles(plan, counts, titles).items():
+    if len(counts[name]) > 0:
+        plotcounts_history(name, title=title)
+# -
@@ -57,11 +57,14 @@ import os
 import pandas as pd
 import numpy as np
 from datetime import date, datetime
-from IPython.display import display, Markdown
+from IPython.display import display, Markdown, HTML
 
 import sys
 sys.path.append('../lib/')
 from functions import *
+from schema import *
+from quality import readprofiles, profiledrift
+from disclosure import redact
 
 
 # +
@@ -76,6 +79,15 @@ with closing_connection(dbconn) as cnxn:
     table_schema = pd.read_sql("""select * from OpenSAFELYSchemaInformation""", cnxn)
 
 today = date.today()
+
+# each run's schema is saved as a snapshot, to compare with on the next run,
+# and the html for each table is cached, so only tables that have changed are rendered again
+# (only when this notebook's earlier outputs are kept, see lib/outputs.py)
+schema_dir = "../output/schema"
+schema = normaliseschema(table_schema)
+hashes = tablehashes(schema)
+previous_date, previous_schema = readsnapshot(os.path.join(schema_dir, "snapshots"), today.strftime('%Y-%m-%d'))
+writesnapshot(os.path.join(schema_dir, "snapshots"), schema, today.strftime('%Y-%m-%d'))
 # -
 
 # ### Notebook run date
@@ -89,6 +101,67 @@ table_names = table_schema[['DataSource', 'TableName']].drop_duplicates().sort_v
 table_names = table_names[table_names['DataSource']!=""]
 display(table_names.reset_index(drop=True).style.set_properties(**{'text-align': 'left'}))
 
+# ## Changed since last build
+# The tables below have been added, removed or changed since the schema was last read by this notebook. For changed tables, the columns that were added, removed, or had their type, precision, scale, length or nullability changed are listed.
+
+if previous_schema is None:
+    display(Markdown("There is no earlier schema to compare with."))
+else:
+    changes = schemachanges(previous_schema, schema)
+    if len(changes) == 0:
+        display(Markdown(f"No tables have changed since {previous_date}."))
+    else:
+        display(Markdown(f"Changes since {previous_date}:"))
+        display(changes.set_index(['DataSource', 'TableName']).style.set_properties(**{'text-align': 'left'}))
+
+# ## Table sizes
+# The table below gives the number of rows, and the space reserved and used (in MB, including indexes), for each table. These are read from the database's own metadata rather than by counting rows, so may differ slightly from an exact count. `LastUpdate` is the last time rows were inserted, updated or deleted since the database server was last restarted (blank if not since then), and `LastSchemaChange` the last time the table's definition was changed.
+
+# +
+try:
+    with closing_connection(dbconn) as cnxn:
+        sizes = pd.read_sql(table_size_query, cnxn)
+except Exception as e:
+    display(Markdown(f"Table sizes could not be read: {e}"))
+else:
+    display(tablesizes(sizes, schema).set_index(['DataSource', 'TableName']))
+# -
+
+# ## Data quality
+# The data quality of each table is profiled for every database build by a single query per table, generated from the column types above. The first table below lists the date columns with dates in the future or before 2009, when the OpenSAFELY-TPP primary care records start, in the latest build. The second lists the columns whose data quality changed since the previous build: a change of more than one percentage point in the proportion of missing values, new future or pre-2009 dates, an earlier first date, or an earlier last date.
+#
+# Counts of five or less are set to 3 for disclosure control. The earliest and latest dates in each column are not shown, as each is the date of a single record.
+
+# +
+profiles = readprofiles("../output/profiles")
+
+if len(profiles) == 0:
+    display(Markdown("No data quality profiles are available."))
+else:
+    latest_build = profiles['build'].max()
+    latest = profiles[profiles['build'] == latest_build].set_index(['table', 'column'])
+    for measure in ['future', 'pre2009']:
+        latest[measure] = redact(latest[measure].astype(float))[0]
+    dates = latest[(latest['future'] > 0) | (latest['pre2009'] > 0)]
+
+    display(Markdown(f"Date columns with dates in the future or before 2009, in the build of {latest_build.strftime('%Y-%m-%d')}:"))
+    if len(dates) == 0:
+        display(Markdown("None."))
+    else:
+        display(dates[['rows', 'null_rate', 'future', 'pre2009']])
+
+    drift = profiledrift(profiles)
+    if profiles['build'].nunique() < 2:
+        display(Markdown("There is no earlier build to compare with."))
+    elif len(drift) == 0:
+        display(Markdown("No columns have changed in data quality since the previous build."))
+    else:
+        for measure in ['future', 'pre2009']:
+            drift[measure] = redact(drift[measure].astype(float))[0]
+        display(Markdown("Columns that changed in data quality since the previous build:"))
+        display(drift[['null_rate_previous', 'null_rate', 'future', 'pre2009', 'change']])
+# -
+
 # ## Table Schema
 #
 # The schema for each table contains the following info:
@@ -98,21 +171,11 @@ display(table_names.reset_index(drop=True).style.set_properties(**{'text-align':
 # * `Precision`, `Scale` and `MaxLength` &mdash; see [SQL Server _precision, scale, and length_ documentation](https://docs.microsoft.com/en-us/sql/t-sql/data-types/precision-scale-and-length-transact-sql) for more details.
 # * `IsNullable`, are Null values accepted.
 #
-# The schema for each table is printed below.
+# The schema for each table is printed below. To find the tables with a particular column, type (part of) its name in the search box, or search for a column type with `type:`, for example `type:date`.
 
 # +
-pd.set_option('display.max_columns', None)
-
-for source in table_names['DataSource'].unique():
-    
-    display(Markdown("\n"))
-    display(Markdown(f"### {source}"))
-    
-    for table in table_names.loc[table_names['DataSource']==source, 'TableName']:
-        tab = table_schema[table_schema['TableName']==table]
-        tab = tab.drop(columns=['TableName', 'DataSource', 'ColumnId', 'CollationName'])
-        display(Markdown(f"#### {table}"))
-        display(tab.set_index('ColumnName'))
+# all tables are rendered together, reusing the html for tables that haven't changed since the last run
+display(HTML(searchhtml(searchindex(schema)) + renderschema(cachedfragments(schema, hashes, os.path.join(schema_dir, "fragments.json")))))
 # +
 
 